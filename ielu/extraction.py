@@ -0,0 +1,1089 @@
+from __future__ import division
+import numpy as np
+from scipy import ndimage
+
+##################################
+# connected component labeling API
+##################################
+
+def connectivity_structure(connectivity=26):
+    '''
+    Returns the 3x3x3 structuring element that connects each voxel to its
+    6 face neighbors, 18 face and edge neighbors, or 26 face, edge and
+    vertex neighbors.
+    '''
+    ranks = {6 : 1, 18 : 2, 26 : 3}
+    try:
+        return ndimage.generate_binary_structure(3, ranks[int(connectivity)])
+    except KeyError:
+        raise ValueError('Connectivity must be one of 6, 18 or 26')
+
+def label_components(image, connectivity=26):
+    '''
+    Label the connected components of the nonzero voxels in image.
+
+    Components are numbered 1..N in the order in which their first voxel
+    appears in a C-order scan of the image, which is the same order in
+    which a flood fill started from each unvisited voxel finds them.
+
+    Parameters
+    ----------
+    image : XxYxZ np.ndarray
+        Image in which every nonzero voxel is a candidate electrode voxel
+    connectivity : 6 | 18 | 26
+        The neighborhood used to connect voxels. The default is 26.
+
+    Returns
+    -------
+    labels : XxYxZ np.ndarray
+        Integer image containing the component index of each voxel, or 0
+    nr_components : int
+        The number of components N
+    '''
+    return ndimage.label(image, structure=connectivity_structure(connectivity))
+
+def label_image_features(image, labels, nr_components, zoom=None,
+    origin=None):
+    '''
+    Compute the feature table of every labeled component at once. See
+    voxel_features.
+
+    If origin is given, image is a crop of a larger volume starting at
+    origin, and the centers are given in the coordinates of that volume.
+
+    Returns
+    -------
+    features : np.ndarray
+        The feature table, with one row per component in label order
+    '''
+    coords = np.nonzero(labels)
+    components = labels[coords]
+    weights = image[coords]
+    if origin is not None:
+        coords = [c + o for c, o in zip(coords, origin)]
+
+    return voxel_features(coords, components, weights, nr_components,
+        zoom=zoom)
+
+def center_of_mass_voxels(coords, components, weights, nr_components,
+    zoom=None):
+    '''
+    Compute the intensity weighted center of mass of every component from
+    a list of its voxels rather than from a label image, rounded to the
+    nearest voxel.
+
+    The voxels must be listed in C-order, as returned by np.nonzero, so
+    that the sums are accumulated in the same order as in
+    ndimage.center_of_mass and the centers are identical.
+
+    Parameters
+    ----------
+    coords : 3-tuple of np.ndarray
+        The coordinates of each voxel along each axis
+    components : np.ndarray
+        The component index 1..N of each voxel
+    weights : np.ndarray
+        The intensity of each voxel
+    nr_components : int
+        The number of components N
+    zoom : None | 3-tuple
+        The zoom factor of each axis to apply to the centers before rounding
+
+    Returns
+    -------
+    centers : List(3-tuple)
+        The center of each component, in label order
+    '''
+    if nr_components == 0:
+        return []
+
+    weights = np.asarray(weights, dtype=float)
+
+    normalizer = np.bincount(components, weights=weights,
+        minlength=nr_components+1)[1:]
+
+    centers = [np.bincount(components, weights=weights*c,
+        minlength=nr_components+1)[1:] / normalizer for c in coords]
+
+    return round_centers(zip(*centers), zoom=zoom)
+
+def round_centers(centers, zoom=None):
+    '''
+    Round a list of centers to the nearest voxel, after multiplying each
+    coordinate by the zoom factor of its axis if zoom is given
+    '''
+    if zoom is None:
+        zoom = (1, 1, 1)
+    return [tuple(round(c*z) for c, z in zip(center, zoom))
+        for center in centers]
+
+feature_dtype = [
+    ('center', float, 3),
+    ('voxels', int),
+    ('intensity_sum', float),
+    ('intensity_max', float),
+    ('extent', int, 3),
+    ('axis_lengths', float, 3),
+]
+
+def voxel_features(coords, components, weights, nr_components, zoom=None):
+    '''
+    Compute a table of features of every component from a list of its
+    voxels, in a single vectorized pass. The table has the fields
+
+    center : the intensity weighted center of mass, as returned by
+        center_of_mass_voxels
+    voxels : the number of voxels
+    intensity_sum, intensity_max : the summed and peak intensity
+    extent : the size of the bounding box along each axis, in voxels
+    axis_lengths : the length of the component along each of its principal
+        axes, longest first, in voxels. This is sqrt(12) times the standard
+        deviation of the voxel positions along the axis, which is the
+        length of a uniformly filled rod or box.
+
+    The voxels must be listed in C-order, as returned by np.nonzero.
+
+    Parameters
+    ----------
+    coords : 3-tuple of np.ndarray
+        The coordinates of each voxel along each axis
+    components : np.ndarray
+        The component index 1..N of each voxel
+    weights : np.ndarray
+        The intensity of each voxel
+    nr_components : int
+        The number of components N
+    zoom : None | 3-tuple
+        The zoom factor of each axis to apply to the centers before rounding
+
+    Returns
+    -------
+    features : np.ndarray
+        The feature table, with one row per component in label order
+    '''
+    features = np.zeros(nr_components, dtype=feature_dtype)
+    if nr_components == 0:
+        return features
+
+    features['center'] = center_of_mass_voxels(coords, components, weights,
+        nr_components, zoom=zoom)
+
+    weights = np.asarray(weights, dtype=float)
+    coords = [np.asarray(c, dtype=float) for c in coords]
+
+    def component_sums(values):
+        return np.bincount(components, weights=values,
+            minlength=nr_components+1)[1:]
+
+    counts = np.bincount(components, minlength=nr_components+1)[1:]
+    features['voxels'] = counts
+    features['intensity_sum'] = component_sums(weights)
+
+    #the maxima and minima are reduced over the voxels grouped by component
+    order = np.argsort(components, kind='mergesort')
+    starts = np.searchsorted(components[order], np.arange(1, nr_components+1))
+
+    features['intensity_max'] = np.maximum.reduceat(weights[order], starts)
+    for axis, c in enumerate(coords):
+        features['extent'][:, axis] = (np.maximum.reduceat(c[order], starts) -
+            np.minimum.reduceat(c[order], starts) + 1)
+
+    means = [component_sums(c) / counts for c in coords]
+    covariance = np.empty((nr_components, 3, 3))
+    for i in xrange(3):
+        for j in xrange(i, 3):
+            covariance[:, i, j] = covariance[:, j, i] = (
+                component_sums(coords[i]*coords[j]) / counts -
+                means[i]*means[j])
+
+    variances = np.linalg.eigvalsh(covariance)[:, ::-1]
+    features['axis_lengths'] = np.sqrt(12 * np.clip(variances, 0, None))
+
+    return features
+
+#######################
+# region of interest API
+#######################
+
+def pad_box(lo, hi, shape, margin):
+    '''
+    Pad the box [lo, hi) by margin voxels on each side, within the volume
+    '''
+    return [(max(0, l - margin), min(dim, h + margin)) for l, h, dim in
+        zip(lo, hi, shape)]
+
+def threshold_bounding_box(ctd, threshold, margin=1):
+    '''
+    Find the bounding box of the voxels above threshold, padded by margin.
+    The volume is thresholded a few planes at a time, so that no full size
+    mask is allocated.
+
+    With a margin of at least one, thresholding, eroding and labeling the
+    box finds the same clusters as the whole volume, since every voxel
+    outside the box is below threshold.
+
+    Returns
+    -------
+    box : None | List(2-tuple)
+        The [start, stop) range of the box along each axis, or None if no
+        voxel is above threshold
+    '''
+    nx, ny, nz = ctd.shape
+    in_x = np.zeros(nx, dtype=bool)
+    in_y = np.zeros(ny, dtype=bool)
+    in_z = np.zeros(nz, dtype=bool)
+
+    step = max(1, 2**24 // max(1, nx*ny))
+    for z0 in xrange(0, nz, step):
+        above = ctd[:, :, z0:z0+step] > threshold
+        in_x |= np.any(above, axis=(1, 2))
+        in_y |= np.any(above, axis=(0, 2))
+        in_z[z0:z0+step] = np.any(above, axis=(0, 1))
+
+    if not np.any(in_x):
+        return None
+
+    lo, hi = zip(*[(np.flatnonzero(a)[0], np.flatnonzero(a)[-1] + 1)
+        for a in (in_x, in_y, in_z)])
+    return pad_box(lo, hi, ctd.shape, margin)
+
+def mask_bounding_box(mask, shape, margin=1):
+    '''
+    Find the bounding box of a mask in CT space, padded by margin, in a
+    volume of the given shape that covers the same space as the mask, such
+    as the isotropized CT volume.
+
+    Returns
+    -------
+    box : None | List(2-tuple)
+        The [start, stop) range of the box along each axis, or None if the
+        mask is empty
+    '''
+    coords = np.nonzero(mask)
+    if len(coords[0]) == 0:
+        return None
+
+    scale = np.array(shape) / mask.shape
+    lo = [int(np.floor(np.min(c) * s)) for c, s in zip(coords, scale)]
+    hi = [int(np.ceil((np.max(c) + 1) * s)) for c, s in zip(coords, scale)]
+    return pad_box(lo, hi, shape, margin)
+
+def intersect_boxes(box1, box2):
+    '''
+    Returns the intersection of two boxes, or None if they do not overlap
+    '''
+    if box1 is None or box2 is None:
+        return None
+
+    box = [(max(l1, l2), min(h1, h2)) for (l1, h1), (l2, h2) in
+        zip(box1, box2)]
+    if any(l >= h for l, h in box):
+        return None
+    return box
+
+def extract_features_near_point(ctd, point, radius=10, threshold=None,
+    use_erosion=True, connectivity=26):
+    '''
+    Threshold, erode and label only a small window of the CT volume around
+    a point, to find electrodes that were missed by the extraction of the
+    whole volume.
+
+    Clusters that reach the side of the window, where it is inside the
+    volume, may be parts of larger objects and are left out.
+
+    Parameters
+    ----------
+    ctd : XxYxZ np.ndarray
+        The CT volume
+    point : 3-tuple
+        The voxel at the center of the window
+    radius : int
+        The window extends radius voxels from point along each axis
+    threshold : None | float
+        The threshold above which voxels are candidates. If None, the
+        threshold is halfway between the median and the maximum of the
+        window, which separates bright objects from the local background.
+    use_erosion : bool
+        If true, binary erosion is applied to the thresholded window
+    connectivity : 6 | 18 | 26
+        The neighborhood used to group voxels into clusters
+
+    Returns
+    -------
+    features : np.ndarray
+        The feature table of the clusters as returned by voxel_features,
+        with centers in the coordinates of the volume
+    threshold : float
+        The threshold used
+    '''
+    center = [int(round(c)) for c in point]
+    box = pad_box(center, [c+1 for c in center], ctd.shape, radius)
+    origin = [lo for lo, hi in box]
+
+    window = np.asarray(ctd[tuple(slice(lo, hi) for lo, hi in box)],
+        dtype=float)
+
+    if threshold is None:
+        background = np.median(window)
+        threshold = background + (np.max(window) - background) / 2
+
+    mask = window > threshold
+    if use_erosion:
+        mask = ndimage.binary_erosion(mask)
+    mask &= (window != 0)
+
+    labels, nr_components = label_components(mask, connectivity=connectivity)
+    features = label_image_features(np.where(mask, window, 0), labels,
+        nr_components, origin=origin)
+
+    #erosion clears the outermost plane of the window, so a cluster that
+    #continues outside the window shows up on the plane inside it
+    edge = 1 if use_erosion else 0
+    truncated = np.zeros(nr_components+1, dtype=bool)
+    for axis, (lo, hi) in enumerate(box):
+        planes = []
+        if lo > 0:
+            planes.append(edge)
+        if hi < ctd.shape[axis]:
+            planes.append(labels.shape[axis] - 1 - edge)
+        for plane in planes:
+            if 0 <= plane < labels.shape[axis]:
+                truncated[np.take(labels, plane, axis=axis)] = True
+
+    return features[~truncated[1:]], threshold
+
+##########################################
+# parallel slab decomposed extraction API
+##########################################
+
+def label_slab(args):
+    '''
+    Threshold, erode and label one z-slab of the CT volume. The slab is
+    passed with a halo of one plane on each side that is interior to the
+    volume, so that erosion of the slab matches erosion of the whole volume.
+
+    Returns the C-order flat indices into the whole volume, image values
+    and slab labels of the clustered voxels, and the labels of the first
+    and last planes of the slab.
+    '''
+    (slab, halo_before, halo_after, z0, shape, threshold, use_erosion,
+        connectivity) = args
+
+    mask = slab > threshold
+    if use_erosion:
+        mask = ndimage.binary_erosion(mask)
+    core = (slice(None), slice(None),
+        slice(halo_before, slab.shape[2] - halo_after))
+    mask = mask[core]
+    slab = slab[core]
+    mask &= (slab != 0)
+
+    labels, nr_components = label_components(mask, connectivity=connectivity)
+
+    x, y, z = np.nonzero(labels)
+    flat = np.ravel_multi_index((x, y, z + z0), shape)
+    return (flat, slab[x, y, z], labels[x, y, z], nr_components,
+        labels[:, :, 0], labels[:, :, -1])
+
+def extract_features_parallel(ctd, threshold, use_erosion=True,
+    connectivity=26, n_jobs=2, zoom=None, origin=None):
+    '''
+    Identify the electrode clusters in a CT volume by thresholding, eroding
+    and labeling z-slabs of the volume in a pool of n_jobs processes, and
+    merging the clusters that touch across slab boundaries.
+
+    The features are identical to, and in the same order as, those found by
+    labeling the whole volume.
+
+    Parameters
+    ----------
+    ctd : XxYxZ np.ndarray
+        The CT volume
+    threshold : float | int
+        The threshold above which voxels are candidates
+    use_erosion : bool
+        If true, binary erosion is applied to the thresholded image
+    connectivity : 6 | 18 | 26
+        The neighborhood used to group voxels into clusters
+    n_jobs : int
+        The number of processes, and of slabs
+    zoom : None | 3-tuple
+        The zoom factor of each axis to apply to the centers before rounding
+    origin : None | 3-tuple
+        The position of ctd in the full volume, if it is a crop
+
+    Returns
+    -------
+    features : np.ndarray
+        The feature table of the clusters as returned by voxel_features, in
+        label order
+    '''
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    nz = ctd.shape[2]
+    bounds = [(b[0], b[-1]+1) for b in
+        np.array_split(np.arange(nz), min(n_jobs, nz))]
+
+    jobs = []
+    for z0, z1 in bounds:
+        halo_before = 1 if z0 > 0 else 0
+        halo_after = 1 if z1 < nz else 0
+        jobs.append((ctd[:, :, z0-halo_before:z1+halo_after], halo_before,
+            halo_after, z0, ctd.shape, threshold, use_erosion, connectivity))
+
+    if n_jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            slabs = pool.map(label_slab, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        slabs = map(label_slab, jobs)
+
+    #give the labels of each slab a distinct range
+    offsets = np.cumsum([0] + [slab[3] for slab in slabs])
+    nr_labels = offsets[-1] + 1
+
+    #connect the clusters that touch across each slab boundary, using the
+    #neighbors one plane ahead in the structuring element
+    structure = connectivity_structure(connectivity)
+    nx, ny = ctd.shape[:2]
+    sources = []
+    targets = []
+    for k in xrange(len(slabs) - 1):
+        last = slabs[k][5]
+        first = slabs[k+1][4]
+        for dx, dy in np.transpose(np.nonzero(structure[:, :, 2])) - 1:
+            a = last[max(0, -dx):nx-max(0, dx), max(0, -dy):ny-max(0, dy)]
+            b = first[max(0, dx):nx-max(0, -dx), max(0, dy):ny-max(0, -dy)]
+            touching = (a != 0) & (b != 0)
+            sources.append(a[touching] + offsets[k])
+            targets.append(b[touching] + offsets[k+1])
+
+    if len(sources) > 0:
+        sources = np.concatenate(sources)
+        targets = np.concatenate(targets)
+    else:
+        sources = targets = np.zeros(0, dtype=int)
+
+    graph = coo_matrix((np.ones(len(sources)), (sources, targets)),
+        shape=(nr_labels, nr_labels))
+    _, merged = connected_components(graph, directed=False)
+
+    flat = np.concatenate([slab[0] for slab in slabs])
+    weights = np.concatenate([slab[1] for slab in slabs])
+    components = np.concatenate([merged[slab[2] + offset] for slab, offset
+        in zip(slabs, offsets)])
+
+    #put the voxels in C-order of the whole volume and number the clusters
+    #by their first voxel, as labeling the whole volume does
+    order = np.argsort(flat, kind='mergesort')
+    flat = flat[order]
+    weights = weights[order]
+    components = components[order]
+
+    cluster_ids, first_voxel = np.unique(components, return_index=True)
+    nr_components = len(cluster_ids)
+    renumber = np.zeros(nr_labels, dtype=int)
+    renumber[components[np.sort(first_voxel)]] = np.arange(1,
+        nr_components+1)
+    components = renumber[components]
+
+    print 'found %i connected components' % nr_components
+
+    coords = np.unravel_index(flat, ctd.shape)
+    if origin is not None:
+        coords = [c + o for c, o in zip(coords, origin)]
+    return voxel_features(coords, components, weights, nr_components,
+        zoom=zoom)
+
+##########################
+# sparse voxel set API
+##########################
+
+def supra_threshold_voxels(ctd, threshold):
+    '''
+    Find the voxels above threshold, thresholding the volume a few planes
+    at a time so that no full size mask is allocated.
+
+    Returns
+    -------
+    flat : np.ndarray
+        The C-order flat indices of the voxels, in increasing order
+    '''
+    nx, ny, nz = ctd.shape
+    step = max(1, 2**24 // max(1, nx*ny))
+
+    flat = []
+    for z0 in xrange(0, nz, step):
+        x, y, z = np.nonzero(ctd[:, :, z0:z0+step] > threshold)
+        flat.append(np.ravel_multi_index((x, y, z + z0), ctd.shape))
+
+    flat = np.concatenate(flat)
+    flat.sort()
+    return flat
+
+def voxel_neighbors(flat, coords, shape, offset):
+    '''
+    Find the neighbor at offset of each voxel in a sparse set of voxels
+
+    Parameters
+    ----------
+    flat : np.ndarray
+        The C-order flat indices of the voxels, in increasing order
+    coords : 3-tuple of np.ndarray
+        The coordinates of the voxels along each axis
+    shape : 3-tuple
+        The shape of the volume
+    offset : 3-tuple
+        The offset of the neighbor along each axis
+
+    Returns
+    -------
+    sources : np.ndarray
+        The index of each voxel whose neighbor is in the set
+    targets : np.ndarray
+        The index of that neighbor
+    '''
+    neighbor = [c + o for c, o in zip(coords, offset)]
+    inside = np.ones(len(flat), dtype=bool)
+    for n, dim in zip(neighbor, shape):
+        inside &= (n >= 0) & (n < dim)
+
+    sources = np.flatnonzero(inside)
+    if len(sources) == 0:
+        return sources, sources
+
+    neighbor_flat = np.ravel_multi_index([n[inside] for n in neighbor],
+        shape)
+    targets = np.searchsorted(flat, neighbor_flat)
+    targets[targets == len(flat)] = 0
+    found = flat[targets] == neighbor_flat
+    return sources[found], targets[found]
+
+def voxel_adjacency(flat, coords, shape, connectivity=26):
+    '''
+    Find every pair of neighboring voxels in a sparse set of voxels, once,
+    as in voxel_neighbors
+    '''
+    structure = connectivity_structure(connectivity)
+    #each neighbor pair is found once from its first voxel in C-order
+    offsets = np.transpose(np.nonzero(structure)) - 1
+    offsets = offsets[len(offsets)//2 + 1:]
+
+    sources, targets = zip(*[voxel_neighbors(flat, coords, shape, offset)
+        for offset in offsets])
+    return np.concatenate(sources), np.concatenate(targets)
+
+def extract_features_sparse(ctd, threshold, use_erosion=True,
+    connectivity=26, zoom=None, origin=None):
+    '''
+    Identify the electrode clusters in a CT volume while only representing
+    the voxels above threshold, as a sorted list of their flat indices.
+    Erosion and grouping look up the neighbors of each voxel in the list,
+    so that the cost grows with the number of voxels above threshold rather
+    than with the size of the volume.
+
+    The features are identical to, and in the same order as, those found
+    by thresholding, eroding and labeling the dense volume.
+
+    Parameters
+    ----------
+    ctd : XxYxZ np.ndarray
+        The CT volume
+    threshold : float | int
+        The threshold above which voxels are candidates
+    use_erosion : bool
+        If true, binary erosion is applied to the thresholded voxels
+    connectivity : 6 | 18 | 26
+        The neighborhood used to group voxels into clusters
+    zoom : None | 3-tuple
+        The zoom factor of each axis to apply to the centers before rounding
+    origin : None | 3-tuple
+        The position of ctd in the full volume, if it is a crop
+
+    Returns
+    -------
+    features : np.ndarray
+        The feature table of the clusters as returned by voxel_features, in
+        label order
+    '''
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    flat = supra_threshold_voxels(ctd, threshold)
+    coords = np.unravel_index(flat, ctd.shape)
+
+    #a voxel survives erosion if its 6 face neighbors are all in the set
+    if use_erosion:
+        nr_neighbors = np.zeros(len(flat), dtype=int)
+        for offset in np.transpose(np.nonzero(
+                ndimage.generate_binary_structure(3, 1))) - 1:
+            if np.any(offset):
+                sources, _ = voxel_neighbors(flat, coords, ctd.shape, offset)
+                nr_neighbors[sources] += 1
+        keep = nr_neighbors == 6
+        flat = flat[keep]
+        coords = [c[keep] for c in coords]
+
+    weights = ctd[tuple(coords)]
+    #voxels of value zero are not part of any cluster
+    keep = weights != 0
+    flat = flat[keep]
+    coords = [c[keep] for c in coords]
+    weights = weights[keep]
+
+    sources, targets = voxel_adjacency(flat, coords, ctd.shape, connectivity)
+    graph = coo_matrix((np.ones(len(sources)), (sources, targets)),
+        shape=(len(flat), len(flat)))
+    nr_components, components = connected_components(graph, directed=False)
+
+    #number the clusters by their first voxel in C-order
+    _, first_voxel = np.unique(components, return_index=True)
+    renumber = np.zeros(nr_components, dtype=int)
+    renumber[components[np.sort(first_voxel)]] = np.arange(1,
+        nr_components+1)
+    components = renumber[components]
+
+    print 'found %i connected components' % nr_components
+
+    if origin is not None:
+        coords = [c + o for c, o in zip(coords, origin)]
+    return voxel_features(coords, components, weights, nr_components,
+        zoom=zoom)
+
+################################
+# memory bounded extraction API
+################################
+
+class MemoryBudget():
+    '''
+    Keeps account of the arrays held during a memory bounded extraction,
+    including the CT volume itself, as a multiple of the size of the raw CT
+    volume. An allocation that would take the total over the cap raises a
+    MemoryError before any memory is requested.
+
+    The account is an estimate made from the sizes of the arrays the
+    extraction allocates, not a measurement of the memory of the process.
+    It does not include the copy of the image that nibabel caches when an
+    image cannot be loaded in its stored dtype, or the temporary arrays of
+    ndimage.
+
+    volume_nbytes : Int
+        The size of the raw CT volume in bytes
+    factor : Float | None
+        The cap, as a multiple of volume_nbytes. If None, allocations are
+        only counted.
+    '''
+    def __init__(self, volume_nbytes, factor=None):
+        self.volume_nbytes = volume_nbytes
+        self.cap = None if factor is None else factor*volume_nbytes
+
+        self.current = volume_nbytes
+        self.peak = volume_nbytes
+
+    def allocate(self, nbytes, what='scratch array'):
+        if self.cap is not None and self.current + nbytes > self.cap:
+            raise MemoryError('Allocating the %s would take CT extraction to '
+                '%.2f times the size of the CT volume, over the budget of '
+                '%.2f' % (what, (self.current+nbytes)/self.volume_nbytes,
+                self.cap/self.volume_nbytes))
+
+        self.current += nbytes
+        self.peak = max(self.peak, self.current)
+
+    def release(self, nbytes):
+        self.current -= nbytes
+
+    def report(self):
+        print ('estimated peak extraction memory %.1f MB, %.2f times the CT '
+            'volume' % (self.peak/2**20, self.peak/self.volume_nbytes))
+
+def load_native_volume(img):
+    '''
+    Load the data of a nibabel image in the dtype it is stored in, without
+    applying the scale factors in the header to the whole volume.
+
+    Returns
+    -------
+    data : XxYxZ np.ndarray
+        The stored image data
+    scaling : None | 2-tuple
+        The (slope, intercept) still to be applied to data, or None if data
+        already holds the image values
+    '''
+    try:
+        data = img.dataobj.get_unscaled()
+        slope, inter = img.dataobj.slope, img.dataobj.inter
+    except AttributeError:
+        return img.get_data(), None
+
+    if slope == 1 and inter == 0:
+        return data, None
+    #only integer images with an increasing scale can be thresholded in
+    #their stored values
+    if not np.issubdtype(data.dtype, np.integer) or slope < 0:
+        return img.get_data(), None
+    return data, (slope, inter)
+
+def apply_scaling(values, scaling):
+    '''
+    Convert stored values to image values in the same way nibabel does when
+    it loads the whole volume
+    '''
+    if scaling is None:
+        return values
+
+    from nibabel.volumeutils import apply_read_scaling
+    slope, inter = scaling
+    return apply_read_scaling(values, slope, inter)
+
+def native_threshold(dtype, scaling, threshold):
+    '''
+    Find the stored value t such that stored values above t are exactly
+    the values whose image value is above threshold. The scaling must be
+    increasing.
+    '''
+    if scaling is None:
+        return threshold
+
+    info = np.iinfo(dtype)
+
+    def above(v):
+        return apply_scaling(np.array([v], dtype=dtype), scaling)[0] > \
+            threshold
+
+    #binary search for the smallest stored value above the threshold
+    lo, hi = int(info.min), int(info.max)
+    if not above(hi):
+        return hi
+    if above(lo):
+        return lo - 1
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if above(mid):
+            hi = mid
+        else:
+            lo = mid
+    return lo
+
+def extract_features_bounded(ctd, threshold, use_erosion=True,
+    connectivity=26, scaling=None, budget=None, zoom=None, origin=None):
+    '''
+    Identify the electrode clusters in a CT volume while holding only
+    boolean masks and a compact label image next to the volume, which is
+    left in its stored dtype.
+
+    The features are identical to those found by thresholding and labeling
+    a floating point copy of the image.
+
+    Parameters
+    ----------
+    ctd : XxYxZ np.ndarray
+        The CT volume in its stored dtype
+    threshold : float | int
+        The threshold, in image values, above which voxels are candidates
+    use_erosion : bool
+        If true, binary erosion is applied to the thresholded mask
+    connectivity : 6 | 18 | 26
+        The neighborhood used to group voxels into clusters
+    scaling : None | 2-tuple
+        The (slope, intercept) converting stored values to image values, as
+        returned by load_native_volume
+    budget : MemoryBudget | None
+        The budget used to account for allocations. If None, allocations
+        are counted but not capped.
+    zoom : None | 3-tuple
+        The zoom factor of each axis to apply to the centers before rounding
+    origin : None | 3-tuple
+        The position of ctd in the full volume, if it is a crop
+
+    Returns
+    -------
+    features : np.ndarray
+        The feature table of the clusters as returned by voxel_features, in
+        label order
+    '''
+    if budget is None:
+        budget = MemoryBudget(ctd.nbytes)
+
+    raw_threshold = native_threshold(ctd.dtype, scaling, threshold)
+
+    budget.allocate(ctd.size, 'threshold mask')
+    mask = ctd > raw_threshold
+
+    #voxels whose image value is exactly zero are not part of any cluster
+    if threshold < 0:
+        raw_zero = native_threshold(ctd.dtype, scaling, 0)
+        if apply_scaling(np.array([raw_zero], dtype=ctd.dtype),
+                scaling)[0] == 0:
+            budget.allocate(ctd.size, 'zero mask')
+            mask &= (ctd != raw_zero)
+            budget.release(ctd.size)
+
+    if use_erosion:
+        budget.allocate(ctd.size, 'eroded mask')
+        eroded = np.empty_like(mask)
+        ndimage.binary_erosion(mask, output=eroded)
+        del mask
+        budget.release(ctd.size)
+        mask = eroded
+
+    #there can be no more components than voxels, so a 16 bit label image
+    #suffices for most images
+    nr_voxels = np.count_nonzero(mask)
+    label_dtype = np.uint16 if nr_voxels < np.iinfo(np.uint16).max else (
+        np.int32)
+    label_nbytes = ctd.size * np.dtype(label_dtype).itemsize
+
+    budget.allocate(label_nbytes, 'label image')
+    labels = np.empty_like(mask, dtype=label_dtype)
+    nr_components = ndimage.label(mask, 
+        structure=connectivity_structure(connectivity), output=labels)
+    del mask
+    budget.release(ctd.size)
+
+    print 'found %i connected components' % nr_components
+
+    #the coordinates, labels and weights of the voxels, and the floating
+    #point coordinates and sort order used for the feature table
+    voxel_nbytes = nr_voxels * (3*8 + 8 + 8 + 3*8 + 8)
+    budget.allocate(voxel_nbytes, 'list of cluster voxels')
+    coords = np.nonzero(labels)
+    components = labels[coords]
+    del labels
+    budget.release(label_nbytes)
+
+    #ndimage numbers the components in the memory order of the label image,
+    #which is not C-order for images loaded from disk. renumber them by the
+    #position of their first voxel in C-order
+    _, first_voxel = np.unique(components, return_index=True)
+    renumber = np.zeros(nr_components+1, dtype=components.dtype)
+    renumber[components[np.sort(first_voxel)]] = np.arange(1,
+        nr_components+1)
+    components = renumber[components]
+
+    weights = apply_scaling(ctd[coords], scaling)
+    if origin is not None:
+        coords = [c + o for c, o in zip(coords, origin)]
+
+    features = voxel_features(coords, components, weights, nr_components,
+        zoom=zoom)
+    budget.release(voxel_nbytes)
+
+    budget.report()
+
+    return features
+
+###################################
+# threshold sweep component tree API
+###################################
+
+class ComponentTree():
+    '''
+    Index of the electrode clusters found at every threshold above
+    min_threshold, built once per CT volume.
+
+    The level of a voxel is the highest threshold at which it survives
+    thresholding and erosion, that is the minimum of the image over its
+    6-neighborhood. Two neighboring voxels are connected at every threshold
+    below the lower of their levels, so the clusters at all thresholds form
+    a tree that is built by merging the voxels along a maximum spanning
+    forest in order of decreasing level. Each node of the tree keeps the
+    sums needed for the center of mass of its cluster.
+
+    The clusters at a threshold are the nodes whose level is above the
+    threshold and whose parent level is not, and are identical to those
+    found by thresholding, eroding and labeling the volume.
+
+    Parameters
+    ----------
+    ctd : XxYxZ np.ndarray
+        The CT volume
+    min_threshold : float | int
+        The lowest threshold that can be queried
+    use_erosion : bool
+        If true, binary erosion is applied to the thresholded image
+    connectivity : 6 | 18 | 26
+        The neighborhood used to group voxels into clusters
+    zoom : None | 3-tuple
+        The zoom factor of each axis to apply to the centers before rounding
+    '''
+    def __init__(self, ctd, min_threshold, use_erosion=True,
+        connectivity=26, zoom=None):
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        self.min_threshold = min_threshold
+        self.zoom = zoom
+
+        if use_erosion:
+            levels = ndimage.grey_erosion(ctd,
+                footprint=ndimage.generate_binary_structure(3, 1))
+        else:
+            levels = ctd
+
+        mask = levels > min_threshold
+        #binary erosion treats the outside of the image as background
+        if use_erosion:
+            for axis in xrange(3):
+                mask[(slice(None),)*axis + (0,)] = False
+                mask[(slice(None),)*axis + (-1,)] = False
+        #voxels of value zero are not part of any cluster
+        mask &= (ctd != 0)
+
+        flat = np.flatnonzero(mask)
+        del mask
+        coords = np.unravel_index(flat, ctd.shape)
+        voxel_levels = levels[coords]
+        weights = np.asarray(ctd[coords], dtype=float)
+        del levels
+
+        nr_voxels = len(flat)
+        print 'building component tree of %i voxels' % nr_voxels
+
+        sources, targets, edge_levels = self._spanning_forest(flat, coords,
+            voxel_levels, ctd.shape, connectivity)
+
+        #leaves of the tree are the voxels, followed by the nodes of merged
+        #clusters. voxels merged by a long run of edges of the same level
+        #join a single node, which holds the same cluster as the last of a
+        #chain of pairwise merges would
+        max_nodes = nr_voxels + len(edge_levels)
+        level = np.empty(max_nodes)
+        level[:nr_voxels] = voxel_levels
+        parent = -np.ones(max_nodes, dtype=int)
+        sums = np.empty((4, max_nodes))
+        sums[:, :nr_voxels] = [weights] + [weights*c for c in coords]
+        first = np.empty(max_nodes, dtype=flat.dtype)
+        first[:nr_voxels] = flat
+        del weights, coords
+
+        #the node of the cluster containing each node is found by following
+        #top, halving the paths followed
+        top = np.arange(max_nodes)
+
+        def find_all(v):
+            root = top[v]
+            while True:
+                up = top[root]
+                if (up == root).all():
+                    break
+                top[root] = top[up]
+                root = top[root]
+            top[v] = root
+            return root
+
+        def find_one(v):
+            root = top[v]
+            while top[root] != root:
+                top[root] = top[top[root]]
+                root = top[root]
+            top[v] = root
+            return root
+
+        sw, sx, sy, sz = sums
+        source_list = sources.tolist()
+        target_list = targets.tolist()
+        nr_nodes = nr_voxels
+        runs = np.flatnonzero(np.diff(edge_levels)) + 1
+        for lo, hi in zip(np.r_[0, runs], np.r_[runs, len(edge_levels)]):
+            if hi - lo < 64:
+                #images resampled to floating point have mostly levels of
+                #a few edges, which are quicker to merge one at a time
+                for e in xrange(lo, hi):
+                    a = find_one(source_list[e])
+                    b = find_one(target_list[e])
+                    level[nr_nodes] = edge_levels[e]
+                    parent[a] = parent[b] = nr_nodes
+                    top[a] = top[b] = nr_nodes
+                    sw[nr_nodes] = sw[a] + sw[b]
+                    sx[nr_nodes] = sx[a] + sx[b]
+                    sy[nr_nodes] = sy[a] + sy[b]
+                    sz[nr_nodes] = sz[a] + sz[b]
+                    first[nr_nodes] = min(first[a], first[b])
+                    nr_nodes += 1
+                continue
+
+            #otherwise the clusters joined at this level, and which of them
+            #are connected by its edges, are found with array operations
+            children, ends = np.unique(np.r_[find_all(sources[lo:hi]),
+                find_all(targets[lo:hi])], return_inverse=True)
+            graph = coo_matrix((np.ones(hi-lo), (ends[:hi-lo], ends[hi-lo:])),
+                shape=(len(children), len(children)))
+            nr_merged, group = connected_components(graph, directed=False)
+
+            nodes = slice(nr_nodes, nr_nodes + nr_merged)
+            level[nodes] = edge_levels[lo]
+            parent[children] = nr_nodes + group
+            top[children] = nr_nodes + group
+            for sum_row in sums:
+                sum_row[nodes] = np.bincount(group, weights=sum_row[children],
+                    minlength=nr_merged)
+            order = np.lexsort((first[children], group))
+            first[nodes] = first[children[order]][np.r_[0,
+                np.flatnonzero(np.diff(group[order])) + 1]]
+
+            nr_nodes += nr_merged
+
+        self.level = level[:nr_nodes]
+        parent = parent[:nr_nodes]
+        self.parent_level = np.where(parent == -1, -np.inf,
+            self.level[parent])
+        self.sums = sums[:, :nr_nodes]
+        self.first = first[:nr_nodes]
+
+    def _spanning_forest(self, flat, coords, voxel_levels, shape,
+        connectivity):
+        '''
+        Find a maximum spanning forest of the graph connecting neighboring
+        voxels, each edge weighted by the lower level of its two voxels.
+
+        Returns the arrays of the two voxels and of the level of the edges of
+        the forest, in order of decreasing level.
+        '''
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import minimum_spanning_tree
+
+        sources, targets = voxel_adjacency(flat, coords, shape, connectivity)
+        #the spanning tree is computed on the rank of each level so that
+        #the edge weights are positive and order is kept exactly
+        unique_levels, voxel_rank = np.unique(voxel_levels,
+            return_inverse=True)
+        rank = np.minimum(voxel_rank[sources], voxel_rank[targets])
+        graph = coo_matrix((len(unique_levels) - rank, (sources, targets)),
+            shape=(len(flat), len(flat)))
+        forest = minimum_spanning_tree(graph).tocoo()
+
+        forest_levels = unique_levels[len(unique_levels) -
+            forest.data.astype(int)]
+        order = np.argsort(-forest_levels, kind='mergesort')
+
+        return forest.row[order], forest.col[order], forest_levels[order]
+
+    def _select(self, threshold):
+        if threshold < self.min_threshold:
+            raise ValueError('The component tree only holds thresholds '
+                'above %s' % self.min_threshold)
+
+        nodes = np.flatnonzero((self.level > threshold) &
+            (self.parent_level <= threshold))
+        return nodes[np.argsort(self.first[nodes])]
+
+    def count(self, threshold):
+        '''
+        Returns the number of clusters found at threshold
+        '''
+        return len(self._select(threshold))
+
+    def centers(self, threshold):
+        '''
+        Returns the center of each cluster found at threshold, in the same
+        order as they are labeled by extraction at that threshold
+        '''
+        nodes = self._select(threshold)
+        sw, sx, sy, sz = self.sums[:, nodes]
+        return round_centers(zip(sx/sw, sy/sw, sz/sw), zoom=self.zoom)
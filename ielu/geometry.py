@@ -112,6 +112,47 @@ def find_neighbors(p0, coords, n):
             ind.remove(ind[which_p])
         return ps
 
+def find_all_neighbors(coords, n, chunk_size=256):
+    '''
+    Batched version of find_neighbors(p, coords, n) for every point p in
+    coords. The squared distances are computed blockwise for chunk_size
+    points at a time and the selection rules of find_nearest_pt, including
+    its tie breaking and its handling of zero distances, are applied to all
+    points at once.
+
+    Returns an (N x n) array of indices into coords, in the order that
+    find_neighbors returns the neighbors.
+    '''
+    coords = np.asarray(coords)
+    n_p = coords.shape[0]
+    if n > n_p - 1:
+        raise ValueError('number of neighbors exceeds the total number of points')
+
+    neighbors = np.zeros((n_p, n), dtype=int)
+
+    for start in xrange(0, n_p, chunk_size):
+        stop = min(start+chunk_size, n_p)
+        d = np.sum((coords[np.newaxis, :, :] -
+            coords[start:stop, np.newaxis, :])**2, axis=2)
+        rows = np.arange(stop-start)
+        valid = np.ones(d.shape, dtype=bool)
+
+        for k in xrange(n):
+            dk = np.where(valid, d, np.inf)
+
+            #like find_nearest_pt, replace the first zero distance with the
+            #maximum distance among the points still available
+            self_rows, = np.where(dk.min(axis=1) == 0)
+            first_zero = np.argmin(dk[self_rows], axis=1)
+            dk[self_rows, first_zero] = np.where(valid[self_rows],
+                d[self_rows], -np.inf).max(axis=1)
+
+            which_p = np.argmin(dk, axis=1)
+            neighbors[start:stop, k] = which_p
+            valid[rows, which_p] = False
+
+    return neighbors
+
 def rm_pts(P, coords):
     ''' 
     This function does not mutate its arguments. It returns a numpy view
@@ -126,6 +167,106 @@ def rm_pts(P, coords):
     
     return coords[ind, :]
 
+class RemainingPoints():
+    '''
+    A persistent spatial index over a fixed set of points, from which points
+    are removed as they get used. It is equivalent to calling
+    find_nearest_pt(p0, rm_pts(used, coords)) but builds its KD-tree only
+    once instead of rescanning every point on each query.
+
+    Removal follows rm_pts: removing a point marks the first point in coords
+    with exactly the same coordinates, and points not in coords are ignored.
+    '''
+    def __init__(self, coords):
+        from scipy.spatial import cKDTree
+        self.coords = np.asarray(coords)
+        self.available = np.ones(len(self.coords), dtype=bool)
+
+        #map coordinates to the first index that has them
+        self.index = {}
+        for i, p in enumerate(map(tuple, self.coords)):
+            self.index.setdefault(p, i)
+
+        self.tree = cKDTree(self.coords) if len(self.coords) > 0 else None
+
+    def remove(self, p):
+        i = self.index.get(tuple(p))
+        if i is not None:
+            self.available[i] = False
+
+    def reset(self):
+        self.available[:] = True
+
+    def points(self):
+        return self.coords[self.available]
+
+    def nearest_distances(self, points):
+        '''
+        Returns the distance from each of the given points to the remaining
+        point that find_nearest_pt(p, self.points()) picks. The remaining
+        points at each point are found with one query for all of the points.
+        A point that is itself among the remaining points is rare, and is
+        searched exhaustively with find_nearest_pt to keep its tie breaking,
+        in which the zero distance is replaced by the largest distance, so
+        that the point itself is picked if no other point is closer than
+        that. The distances are inf if no points remain.
+        '''
+        points = np.reshape(points, (-1,3))
+        distances = np.empty(len(points))
+
+        nr_left = np.count_nonzero(self.available)
+        if nr_left == 0:
+            distances[:] = np.inf
+            return distances
+
+        #at most nr_used of the nearest points can be used ones, so a
+        #remaining point at the point itself is among the first nr_used+1
+        k = min(len(self.coords) - nr_left + 1, len(self.coords))
+        dists, inds = self.tree.query(points, k=k)
+        dists = np.reshape(dists, (len(points), k))
+        inds = np.reshape(inds, (len(points), k))
+
+        for i, p in enumerate(points):
+            at_self = np.any(dists[i][self.available[inds[i]]] == 0)
+            p1, _ = self.nearest(p, allow_self=not at_self)
+            distances[i] = norm(p1 - p)
+
+        return distances
+
+    def nearest(self, p0, allow_self=False):
+        '''
+        Returns the nearest remaining point to p0 and its index in points(),
+        with the same tie breaking as find_nearest_pt. Raises ValueError if
+        no points remain.
+        '''
+        nr_left = np.count_nonzero(self.available)
+        if nr_left == 0:
+            raise ValueError('no points remaining')
+
+        #excluding p0 itself is rare, use the exhaustive search for it
+        if not allow_self:
+            return find_nearest_pt(p0, self.points(), allow_self=False)
+
+        #at most nr_used of the nearest points can be used ones
+        k = min(len(self.coords) - nr_left + 1, len(self.coords))
+        dists, inds = self.tree.query(p0, k=k)
+        dists = np.atleast_1d(dists)
+        inds = np.atleast_1d(inds)
+        radius = dists[self.available[inds]].min()
+
+        if not np.isfinite(radius):
+            return find_nearest_pt(p0, self.points(), allow_self=True)
+
+        #collect every candidate within the tree distance, with some slack
+        #for rounding, and take the exact squared distances
+        cands = np.array(self.tree.query_ball_point(p0,
+            radius*(1+1e-9)+1e-12), dtype=int)
+        cands = np.sort(cands[self.available[cands]])
+        d = np.sum((self.coords[cands]-p0)**2, axis=1)
+
+        which = cands[np.argmin(d)]
+        return self.coords[which], np.count_nonzero(self.available[:which])
+
 ############################
 # compound utility functions
 ############################
@@ -172,6 +313,20 @@ def binarize(W):
     W[W!=0]=1
     return W
 
+def window_sums(W, h, w):
+    '''
+    Sum W over every h by w window that fits inside it, using a summed area
+    table. Returns an array whose element (i,j) is np.sum(W[i:i+h, j:j+w]).
+    '''
+    rows = max(W.shape[0]-h+1, 0)
+    cols = max(W.shape[1]-w+1, 0)
+
+    S = np.zeros((W.shape[0]+1, W.shape[1]+1), dtype=W.dtype)
+    S[1:, 1:] = np.cumsum(np.cumsum(W, axis=0), axis=1)
+
+    return (S[h:h+rows, w:w+cols] - S[:rows, w:w+cols] -
+        S[h:h+rows, :cols] + S[:rows, :cols])
+
 def truncate(f, n):
     return math.floor(f*10**n)/10**n
 
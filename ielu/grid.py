@@ -1,30 +1,11 @@
 from __future__ import division
 import numpy as np
 from numpy.linalg import norm
-from geometry import (angle, is_parallel, is_perpend, within_distance, rm_pts,
-    find_nearest_pt, find_neighbors, binarize)
+from geometry import (angle, is_parallel, is_perpend, within_distance,
+    find_neighbors, find_all_neighbors, binarize, window_sums,
+    RemainingPoints)
 from utils import SortingLabelingError
 
-class GridPoint():
-    #this is just a class to make 3D arrays hashable
-
-    #def __init__(self, 3d_loc, 2d_loc):
-        #self.2d_loc = 2d_loc
-    def __init__(self, loc_3d):
-        self.loc_3d = np.array(loc_3d)
-
-    def __hash__(self):
-        return hash(str(self))
-
-    def __eq__(self, other):
-        return np.all(self.loc_3d == other.loc_3d)
-
-    def __str__(self):
-        return str(self.loc_3d)
-
-    def __repr__(self):
-        return str(self)
-
 class Grid():
     '''
     p0, p1, p2 : 3x 3-tuple
@@ -81,6 +62,12 @@ class Grid():
         else:
             self.points = [p0, p1, p2]
 
+        #keep a spatial index of the electrodes not yet used so that nearest
+        #point queries dont rescan all of the electrodes
+        self.remaining = RemainingPoints(all_elecs)
+        for p in self.points:
+            self.remaining.remove(p)
+
         #maintain an unsorted list of distances that have been created so far
         #to easily calculate the average distance
         self.distances = [norm(p0-p1)]
@@ -88,14 +75,18 @@ class Grid():
         #not necessary for line, we can get better estimate but probably will
         #work in 99% of cases
 
-        #maintain a dictionary mapping 3D locations to 2D locations on a grid.
+        #points are identified by their index in all_elecs, points that are
+        #not electrodes (interpolated points) get an index past the end
+        self.extra_ids = {}
+
+        #maintain a dictionary mapping point indices to 2D locations on a grid.
         #this is used mostly as a sparse mapping of 2D grid points so that local connectivity
         #can be easily examined, 
 
         if is_line:
-            self.connectivity = { GridPoint(p0) : (0,0),
-                                  GridPoint(p1) : (0,1), 
-                                  #GridPoint(p2) : (0,-1), 
+            self.connectivity = { self.new_point_id(p0) : (0,0),
+                                  self.new_point_id(p1) : (0,1), 
+                                  #self.new_point_id(p2) : (0,-1), 
                                 }
 
             self.reverse_connectivity = {(0,0) : p0,
@@ -106,9 +97,9 @@ class Grid():
             self.is_line = True
 
         else:
-            self.connectivity = { GridPoint(p0) : (0,0),
-                                  GridPoint(p1) : (0,1), 
-                                  GridPoint(p2) : (1,0), }
+            self.connectivity = { self.new_point_id(p0) : (0,0),
+                                  self.new_point_id(p1) : (0,1), 
+                                  self.new_point_id(p2) : (1,0), }
 
             self.reverse_connectivity = {(0,0) : p0,
                                          (0,1) : p1,
@@ -175,15 +166,14 @@ class Grid():
         return graph
 
     def remaining_points(self):
-        return rm_pts( self.points, self.all_elecs )
+        return self.remaining.points()
 
     def critdist(self):
         return np.mean(self.distances)
 
     def nearest(self, p0, allow_self=True):
         try:
-            p,_ = find_nearest_pt(p0, self.remaining_points(), 
-                allow_self=allow_self)
+            p,_ = self.remaining.nearest(p0, allow_self=allow_self)
             return p
         except (IndexError, ValueError):
         #except IndexError:
@@ -195,6 +185,7 @@ class Grid():
 
         #update the set of all 3D coordinates for easy removal of coordinates
         self.points.append(pJ)
+        self.remaining.remove(pJ)
 
         #update the set of distances for easy calculation of the average distance
         x,y = coord_2d
@@ -208,18 +199,45 @@ class Grid():
             raise ValueError("Internal error: No distances were added")
 
         #update the connectivity dictionary with the proper 2D coordinate
-        p = GridPoint( pJ ) 
-        if p in self.connectivity.keys():
+        p = self.new_point_id( pJ ) 
+        if p in self.connectivity:
             print self
             raise ValueError("Tried to reproduce an existing 2D grid point")
         self.connectivity[p] = coord_2d
         self.reverse_connectivity[coord_2d] = pJ
 
+    def point_id(self, p):
+        #takes a 3D point and returns its index, or None for an unknown point
+        if p is None:
+            return None
+        key = tuple(p)
+        i = self.remaining.index.get(key)
+        if i is None:
+            i = self.extra_ids.get(key)
+        return i
+
+    def new_point_id(self, p):
+        #like point_id, but gives points that arent electrodes a new index
+        i = self.point_id(p)
+        if i is None:
+            i = len(self.all_elecs) + len(self.extra_ids)
+            self.extra_ids[tuple(p)] = i
+        return i
+
+    def has_point(self, p):
+        return self.point_id(p) in self.connectivity
+
     def get_3d_point(self, coord_2d):
         try:
             return self.reverse_connectivity[coord_2d]
         except KeyError:
             return None
+
+    def get_2d_point(self, p):
+        try:
+            return self.connectivity[self.point_id(p)]
+        except KeyError:
+            return None
 #        for p,c in zip(self.connectivity, self.connectivity.values()):
 #            if np.all(np.array(c) == np.array(coord_2d) ):
 #                return p.loc_3d
@@ -234,7 +252,7 @@ class Grid():
 
     def get_local_connectivity_3d(self, p):
         #takes a 3D point and checks the connectivity
-        coord_2d = self.connectivity[GridPoint(p)]
+        coord_2d = self.connectivity[self.point_id(p)]
         return self.get_local_connectivity_2d(coord_2d)
 
     def get_local_connectivity_2d(self, coord_2d):
@@ -299,7 +317,7 @@ class Grid():
         #applies nr_rotations counterclockwise rotations
         #and returns the 2D coordinates of the result.
         
-        p_orient_2d = self.connectivity[ GridPoint( p_orient_3d )]
+        p_orient_2d = self.connectivity[ self.point_id( p_orient_3d )]
         x,y = p_orient_2d
 
         if orientation == 'north':
@@ -363,7 +381,7 @@ class Grid():
             the angle p1-p0-pJ is within rho degrees of 90
             the angle p1-p0-pJ is within rho_strict degrees of the angle p1-p0-p2
         '''
-        if GridPoint(pJ) in self.connectivity:
+        if self.has_point(pJ):
             return False
 
         c = self.critdist()
@@ -381,7 +399,7 @@ class Grid():
             the distance d (p0-pJ) is c*(1-delta) < d < c*(1+delta) where c is critdist()
             the angle p1-p0-pJ is within rho degrees of 180
         '''
-        if GridPoint(pJ) in self.connectivity:
+        if self.has_point(pJ):
             return False
 
         #import pdb
@@ -402,7 +420,7 @@ class Grid():
         note that the actual p0 being evaluated is p1 or p2, and pOrig is a point
         next to p0
         '''
-        if GridPoint(pC) in self.connectivity:
+        if self.has_point(pC):
             return False
         if p1 is None or p2 is None:
             return False
@@ -424,7 +442,7 @@ class Grid():
 
         here, p0 is the actual p0 next to pJ unlike in the above method
         '''
-        if GridPoint(pJ) in self.connectivity:
+        if self.has_point(pJ):
             return False
         if p1 is None or pX is None or pZ is None:
             return False
@@ -436,15 +454,57 @@ class Grid():
         return (distance_cond and angle_cond and parallel_cond)
 
     def extend_grid_arbitrarily(self):
-        points = []
-        while len(self.points) != len(points):
-            for point in map(GridPoint, self.points):
+        '''
+        extends the grid until no more points can be added. each pass
+        examines the points in the same order as extend_grid_systematically,
+        but skips the points that cannot have changed: the ones whose
+        neighborhood is the same as when they were marked as unextendable.
+        '''
+        import heapq
+
+        #the position in self.points of each 2D location
+        positions = {}
+        for i, p in enumerate(self.points):
+            positions[self.get_2d_point(p)] = i
+
+        #the first pass examines every point
+        frontier = range(len(self.points))
+        next_frontier = set()
+
+        nr_points = 0
+        while len(self.points) != nr_points:
+            #the connectivity holds each distinct point once
+            nr_points = len(self.connectivity)
+
+            queued = set(frontier)
+            while frontier:
+                i = heapq.heappop(frontier)
+
+                nr_before = len(self.points)
+                if self.extend_grid_from_point(self.points[i]):
+                    next_frontier.add(i)
+
+                #the new points and their neighbors have to be examined,
+                #in this pass if they come later in the order or else in the
+                #next one
+                for j in xrange(nr_before, len(self.points)):
+                    x,y = self.get_2d_point(self.points[j])
+                    positions[(x,y)] = j
+                    for coord in ((x,y), (x+1,y), (x,y-1), (x-1,y), (x,y+1)):
+                        self.marked.pop(coord, None)
+                        k = positions.get(coord)
+                        if k is None:
+                            continue
+                        if k <= i:
+                            next_frontier.add(k)
+                        elif k not in queued:
+                            heapq.heappush(frontier, k)
+                            queued.add(k)
 
-                if point not in points:
-                    points.append(point)
+            frontier = sorted(next_frontier)
+            next_frontier = set()
 
-            self.extend_grid_systematically()
-            print 'started with %i points, now has %i' % (len(points), len(self.points))
+            print 'started with %i points, now has %i' % (nr_points, len(self.points))
 
     def recreate_geometry(self):
         '''
@@ -470,175 +530,184 @@ class Grid():
         in the plane
         '''
         for p0 in self.points:
-            pts_added = False
+            self.extend_grid_from_point(p0)
 
-            local_connectivity, orient = self.get_local_connectivity_3d(p0)
+    def extend_grid_from_point(self, p0):
+        '''
+        tries to extend the grid in all directions in the plane from one point.
+        returns true if any points were added
+        '''
+        pts_added = False
 
-            if local_connectivity in ('FULL', 'SINGLETON'):
-                continue
+        local_connectivity, orient = self.get_local_connectivity_3d(p0)
 
-            x,y = self.connectivity[GridPoint(p0)]
-        
-            if self.is_marked((x,y), local_connectivity):
-                continue
+        if local_connectivity in ('FULL', 'SINGLETON'):
+            return False
 
-            p1 = self.get_3d_point( (
-                x-int(orient=='west')+int(orient=='east'),
-                y+int(orient=='north')-int(orient=='south') ))
-                
-            if local_connectivity == 'MOTIF':
-                #check to extend the motif in both directions
-                p2 = self.get_3d_point( self.ccw_point(orient, p1, nr_rot=1) )
-                pJa = self.nearest( 2*p0-p2 )
-                pJa_coord = self.ccw_point(orient, p1, nr_rot=3)
-                if self.fits_cross_motif(pJa, p0, p1, p2):
-                    self.add_point(pJa, pJa_coord)
+        x,y = self.connectivity[self.point_id(p0)]
+    
+        if self.is_marked((x,y), local_connectivity):
+            return False
+
+        p1 = self.get_3d_point( (
+            x-int(orient=='west')+int(orient=='east'),
+            y+int(orient=='north')-int(orient=='south') ))
+            
+        if local_connectivity == 'MOTIF':
+            #check to extend the motif in both directions
+            p2 = self.get_3d_point( self.ccw_point(orient, p1, nr_rot=1) )
+            pJa = self.nearest( 2*p0-p2 )
+            pJa_coord = self.ccw_point(orient, p1, nr_rot=3)
+            if self.fits_cross_motif(pJa, p0, p1, p2):
+                self.add_point(pJa, pJa_coord)
+                pts_added = True
+
+            pJb = self.nearest( 2*p0-p1 )
+            pJb_coord = self.ccw_point(orient, p1, nr_rot=2)
+            if self.fits_cross_motif(pJb, p0, p2, p1):
+                self.add_point(pJb, pJb_coord)
+                pts_added = True
+
+        if local_connectivity == 'TSHAPE':
+            # figure out which side of the T is not covered and extend to it using some combination of
+            # the two available motif extensions and the line extension
+
+            pA = self.get_3d_point( self.ccw_point(orient, p1, nr_rot=1) )
+            pB = self.get_3d_point( self.ccw_point(orient, p1, nr_rot=3) )
+
+            pJ = self.nearest( 2*p0 - p1 )
+            pJ_coord = self.ccw_point(orient, p1, nr_rot=2)
+
+            line_cond = self.fits_line( pJ, p0, p1 )
+            left_motif_cond = self.fits_cross_motif( pJ, p0, pA, p1 )
+            right_motif_cond = self.fits_cross_motif( pJ, p0, pB, p1 )
+
+            if (line_cond + left_motif_cond + right_motif_cond >= 2):
+                self.add_point(pJ, pJ_coord)
+                pts_added = True
+
+        if local_connectivity == 'LEAF':
+            # do the line extension 
+            pL = self.nearest( 2*p0-p1 )
+            pL_coord = self.ccw_point(orient, p1, nr_rot=2)
+            if self.fits_line( pL, p0, p1 ):
+                self.add_point(pL, pL_coord) 
+                pts_added = True
+
+            # check for corner extension
+            opp_orient = self.ccw_orientation(orient, nr_rot=2)
+            pCa_coord = self.ccw_point(orient, p1, nr_rot=1)
+            pCb_coord = self.ccw_point(orient, p1, nr_rot=3)
+
+            pSa = self.get_3d_point( self.ccw_point( opp_orient, p0, 
+                nr_rot=3 ))
+            if pSa is not None:
+                pCa = self.nearest( p0+pSa-p1 )
+                if self.fits_corner( pCa, p1, p0, pSa):
+                    self.add_point(pCa, pCa_coord)
+                    pts_added = True
+            pSb = self.get_3d_point( self.ccw_point( opp_orient, p0, 
+                nr_rot=1 ))
+            if pSb is not None:
+                pCb = self.nearest( p0+pSb-p1 )
+                if self.fits_corner( pCb, p1, p0, pSb):
+                    self.add_point(pCb, pCb_coord) 
                     pts_added = True
 
-                pJb = self.nearest( 2*p0-p1 )
-                pJb_coord = self.ccw_point(orient, p1, nr_rot=2)
-                if self.fits_cross_motif(pJb, p0, p2, p1):
-                    self.add_point(pJb, pJb_coord)
+            # check for parallel extension
+            pX = self.get_3d_point( self.ccw_point( opp_orient, p0,  
+                nr_rot=2))
+            pZa = self.get_3d_point( self.ccw_point( opp_orient, p1, 
+                nr_rot=3))
+            if pZa is not None and pX is not None:
+                pIa = self.nearest( p0+pZa-pX )
+                if self.fits_parallel( pIa, p0, p1, pX, pZa):
+                    self.add_point(pIa, pCa_coord) 
+                    pts_added = True
+            pZb = self.get_3d_point( self.ccw_point( opp_orient, p1, 
+                nr_rot=1))
+            if pZb is not None and pX is not None:
+                pIb = self.nearest( p0+pZb-pX )
+                if self.fits_parallel( pIb, p0, p1, pX, pZb):
+                    self.add_point(pIb, pCb_coord)
                     pts_added = True
 
-            if local_connectivity == 'TSHAPE':
-                # figure out which side of the T is not covered and extend to it using some combination of
-                # the two available motif extensions and the line extension
+        if local_connectivity == 'LINE':
+
+            p2 = self.get_3d_point( self.ccw_point( orient, p1, nr_rot=2))
+            pCa_coord = self.ccw_point(orient, p1, nr_rot=1)
+            pCb_coord = self.ccw_point(orient, p1, nr_rot=3)
+            opp_orient = self.ccw_orientation(orient, nr_rot=2)
+
+            pSa = self.get_3d_point( self.ccw_point( opp_orient, p0, 
+                nr_rot=3 ))
+            pSd = self.get_3d_point( self.ccw_point( orient, p0, 
+                nr_rot=1 ))
+
+            if pSa is not None or pSd is not None: 
+                pCa = (self.nearest(p0+pSa-p1) if pSa is not None else 
+                    self.nearest(p0+pSd-p2))
+                corner_1 = self.fits_corner(pCa, p1, pSa, p0)
+                corner_2 = self.fits_corner(pCa, p2, pSd, p0)
+                if corner_1 or corner_2:
+                    self.add_point(pCa, pCa_coord)
+                    pts_added = True
 
-                pA = self.get_3d_point( self.ccw_point(orient, p1, nr_rot=1) )
-                pB = self.get_3d_point( self.ccw_point(orient, p1, nr_rot=3) )
+            pSb = self.get_3d_point( self.ccw_point( opp_orient, p0, 
+                nr_rot=1 ))
+            pSc = self.get_3d_point( self.ccw_point( orient, p0, 
+                nr_rot=3 ))
+
+            if pSb is not None or pSc is not None:
+                pCb = (self.nearest(p0+pSb-p1) if pSb is not None else
+                    self.nearest(p0+pSc-p2))
+                corner_1 = self.fits_corner(pCb, p1, pSb, p0)
+                corner_2 = self.fits_corner(pCb, p2, pSc, p0)
+                if corner_1 or corner_2:
+                    self.add_point(pCb, pCb_coord)
+                    pts_added = True
 
-                pJ = self.nearest( 2*p0 - p1 )
-                pJ_coord = self.ccw_point(orient, p1, nr_rot=2)
+            # check for parallel extension
+            pX = self.get_3d_point( self.ccw_point( opp_orient, p0, 
+                nr_rot=2))
+            pY = self.get_3d_point( self.ccw_point( orient, p0, nr_rot=2))
 
-                line_cond = self.fits_line( pJ, p0, p1 )
-                left_motif_cond = self.fits_cross_motif( pJ, p0, pA, p1 )
-                right_motif_cond = self.fits_cross_motif( pJ, p0, pB, p1 )
+            pZa = self.get_3d_point( self.ccw_point( opp_orient, p1, 
+                nr_rot=3))
+            pZd = self.get_3d_point( self.ccw_point( orient, p2, 
+                nr_rot=1 ))
 
-                if (line_cond + left_motif_cond + right_motif_cond >= 2):
-                    self.add_point(pJ, pJ_coord)
+            if ((pZa is not None and pX is not None) or 
+                    (pZd is not None and pY is not None)):
+                if pX is not None and pZa is not None:
+                    pIa = self.nearest( p0+pZa-pX )
+                elif pY is not None and pZd is not None:
+                    pIa = self.nearest( p0+pZd-pY )
+                parallel_1 = self.fits_parallel(pIa, p0, p1, pX, pZa)
+                parallel_2 = self.fits_parallel(pIa, p0, p2, pY, pZd)
+                if parallel_1 or parallel_2:
+                    self.add_point(pIa, pCa_coord) 
                     pts_added = True
-
-            if local_connectivity == 'LEAF':
-                # do the line extension 
-                pL = self.nearest( 2*p0-p1 )
-                pL_coord = self.ccw_point(orient, p1, nr_rot=2)
-                if self.fits_line( pL, p0, p1 ):
-                    self.add_point(pL, pL_coord) 
+            pZb = self.get_3d_point( self.ccw_point( opp_orient, p1, 
+                nr_rot=1))
+            pZc = self.get_3d_point( self.ccw_point( orient, p2, 
+                nr_rot=3 ))
+            if ((pZb is not None and pX is not None) or 
+                    (pZc is not None and pY is not None)):
+                if pX is not None and pZb is not None:
+                    pIb = self.nearest( p0+pZb-pX )
+                elif pY is not None and pZc is not None:
+                    pIb = self.nearest( p0+pZc-pY )
+                parallel_1 = self.fits_parallel(pIb, p0, p1, pX, pZb)
+                parallel_2 = self.fits_parallel(pIb, p0, p2, pY, pZc)
+                if parallel_1 or parallel_2:
+                    self.add_point(pIb, pCb_coord)
                     pts_added = True
 
-                # check for corner extension
-                opp_orient = self.ccw_orientation(orient, nr_rot=2)
-                pCa_coord = self.ccw_point(orient, p1, nr_rot=1)
-                pCb_coord = self.ccw_point(orient, p1, nr_rot=3)
-
-                pSa = self.get_3d_point( self.ccw_point( opp_orient, p0, 
-                    nr_rot=3 ))
-                if pSa is not None:
-                    pCa = self.nearest( p0+pSa-p1 )
-                    if self.fits_corner( pCa, p1, p0, pSa):
-                        self.add_point(pCa, pCa_coord)
-                        pts_added = True
-                pSb = self.get_3d_point( self.ccw_point( opp_orient, p0, 
-                    nr_rot=1 ))
-                if pSb is not None:
-                    pCb = self.nearest( p0+pSb-p1 )
-                    if self.fits_corner( pCb, p1, p0, pSb):
-                        self.add_point(pCb, pCb_coord) 
-                        pts_added = True
-
-                # check for parallel extension
-                pX = self.get_3d_point( self.ccw_point( opp_orient, p0,  
-                    nr_rot=2))
-                pZa = self.get_3d_point( self.ccw_point( opp_orient, p1, 
-                    nr_rot=3))
-                if pZa is not None and pX is not None:
-                    pIa = self.nearest( p0+pZa-pX )
-                    if self.fits_parallel( pIa, p0, p1, pX, pZa):
-                        self.add_point(pIa, pCa_coord) 
-                        pts_added = True
-                pZb = self.get_3d_point( self.ccw_point( opp_orient, p1, 
-                    nr_rot=1))
-                if pZb is not None and pX is not None:
-                    pIb = self.nearest( p0+pZb-pX )
-                    if self.fits_parallel( pIb, p0, p1, pX, pZb):
-                        self.add_point(pIb, pCb_coord)
-                        pts_added = True
-
-            if local_connectivity == 'LINE':
-
-                p2 = self.get_3d_point( self.ccw_point( orient, p1, nr_rot=2))
-                pCa_coord = self.ccw_point(orient, p1, nr_rot=1)
-                pCb_coord = self.ccw_point(orient, p1, nr_rot=3)
-                opp_orient = self.ccw_orientation(orient, nr_rot=2)
-
-                pSa = self.get_3d_point( self.ccw_point( opp_orient, p0, 
-                    nr_rot=3 ))
-                pSd = self.get_3d_point( self.ccw_point( orient, p0, 
-                    nr_rot=1 ))
-
-                if pSa is not None or pSd is not None: 
-                    pCa = (self.nearest(p0+pSa-p1) if pSa is not None else 
-                        self.nearest(p0+pSd-p2))
-                    corner_1 = self.fits_corner(pCa, p1, pSa, p0)
-                    corner_2 = self.fits_corner(pCa, p2, pSd, p0)
-                    if corner_1 or corner_2:
-                        self.add_point(pCa, pCa_coord)
-                        pts_added = True
-
-                pSb = self.get_3d_point( self.ccw_point( opp_orient, p0, 
-                    nr_rot=1 ))
-                pSc = self.get_3d_point( self.ccw_point( orient, p0, 
-                    nr_rot=3 ))
-
-                if pSb is not None or pSc is not None:
-                    pCb = (self.nearest(p0+pSb-p1) if pSb is not None else
-                        self.nearest(p0+pSc-p2))
-                    corner_1 = self.fits_corner(pCb, p1, pSb, p0)
-                    corner_2 = self.fits_corner(pCb, p2, pSc, p0)
-                    if corner_1 or corner_2:
-                        self.add_point(pCb, pCb_coord)
-                        pts_added = True
-
-                # check for parallel extension
-                pX = self.get_3d_point( self.ccw_point( opp_orient, p0, 
-                    nr_rot=2))
-                pY = self.get_3d_point( self.ccw_point( orient, p0, nr_rot=2))
-
-                pZa = self.get_3d_point( self.ccw_point( opp_orient, p1, 
-                    nr_rot=3))
-                pZd = self.get_3d_point( self.ccw_point( orient, p2, 
-                    nr_rot=1 ))
-
-                if ((pZa is not None and pX is not None) or 
-                        (pZd is not None and pY is not None)):
-                    if pX is not None and pZa is not None:
-                        pIa = self.nearest( p0+pZa-pX )
-                    elif pY is not None and pZd is not None:
-                        pIa = self.nearest( p0+pZd-pY )
-                    parallel_1 = self.fits_parallel(pIa, p0, p1, pX, pZa)
-                    parallel_2 = self.fits_parallel(pIa, p0, p2, pY, pZd)
-                    if parallel_1 or parallel_2:
-                        self.add_point(pIa, pCa_coord) 
-                        pts_added = True
-                pZb = self.get_3d_point( self.ccw_point( opp_orient, p1, 
-                    nr_rot=1))
-                pZc = self.get_3d_point( self.ccw_point( orient, p2, 
-                    nr_rot=3 ))
-                if ((pZb is not None and pX is not None) or 
-                        (pZc is not None and pY is not None)):
-                    if pX is not None and pZb is not None:
-                        pIb = self.nearest( p0+pZb-pX )
-                    elif pY is not None and pZc is not None:
-                        pIb = self.nearest( p0+pZc-pY )
-                    parallel_1 = self.fits_parallel(pIb, p0, p1, pX, pZb)
-                    parallel_2 = self.fits_parallel(pIb, p0, p2, pY, pZc)
-                    if parallel_1 or parallel_2:
-                        self.add_point(pIb, pCb_coord)
-                        pts_added = True
-
-            if not pts_added:
-                self.marked[(x,y)] = local_connectivity
+        if not pts_added:
+            self.marked[(x,y)] = local_connectivity
+
+        return pts_added
 
     def extract_strip(self, N, M):
         '''
@@ -747,6 +816,11 @@ class Grid():
         #set the critical distance before we start adding points
         critdist = self.critdist()
 
+        #the penalties of all candidates are taken against a single spatial
+        #index of the electrodes, from which each candidate removes its own
+        #points
+        elecs = RemainingPoints(self.all_elecs)
+
         for r,c,orient in potential_strip_locs:
 
             cur_penalty = 0
@@ -863,7 +937,7 @@ class Grid():
                         #choice. We should add it to the interpolated
                         #points  as normally, but not add the point to the Grid
 
-                    elif GridPoint(pInterp) in self.connectivity:
+                    elif self.has_point(pInterp):
                         # suppose the exact point to be interpolated at i,j is actually
                         # already in the grid at m,n and the grid has horribly
                         # twisted over itself. To gracefully handle this (the
@@ -894,15 +968,19 @@ class Grid():
                     #interpolated_gridpoints.append(GridPoint(pInterp))
                     interpolated_gridpoints.append((i,j))
 
-                    points_left = rm_pts(cur_points, self.all_elecs)
-                    
-                    if len(points_left) > 0:
-                        pPenalty, _ = find_nearest_pt(pInterp, 
-                            rm_pts(cur_points, self.all_elecs))
-                        cur_penalty += np.min((norm(pPenalty-pInterp), 
-                            2*self.delta*critdist))
-                    else:
-                        cur_penalty = np.inf
+
+            #penalize each interpolated point by the distance to the nearest
+            #electrode not in the strip
+            elecs.reset()
+            for p in cur_points:
+                elecs.remove(p)
+
+            if len(interpolated_points) > 0:
+                if not np.any(elecs.available):
+                    cur_penalty = np.inf
+                else:
+                    for d in elecs.nearest_distances(interpolated_points):
+                        cur_penalty += np.min((d, 2*self.delta*critdist))
 
             #update the winner
             if cur_penalty < best_penalty:
@@ -916,33 +994,22 @@ class Grid():
     def matches_strip_geometry(self, M, N, graph):
         #graph = self.repr_as_2d_graph(pad_zeros = max(M,N))
 
-        best_locs = []
-        best_fit = -1
+        #count the filled nodes of every placement at once. the row
+        #dimension of a 'vert' placement is M, so those counts are transposed
+        #to be indexed by (r, c) like in the 'horiz' orientation
+        filled = binarize(graph)
+        fits = {'horiz' : window_sums(filled, N, M),
+                'vert' : window_sums(filled, M, N).T}
+
+        best_fit = max([fits[orient].max() for orient in fits
+            if fits[orient].size > 0] or [-1])
 
         #If the orientation is 'horiz', then the row dimension corresponds to N.
         #if is 'vert', the row dimension corresponds to M
+        best_locs = []
         for orient in ('horiz', 'vert'):
-            for r in xrange(graph.shape[int(orient=='vert')]-N+1):
-                for c in xrange(graph.shape[int(orient=='horiz')]-M+1):
-                    cur_loc = (r, c, orient)
-                    subgraph = (graph[r:r+N, c:c+M] if orient=='horiz' 
-                        else graph[c:c+M, r:r+N])
-
-                    #if the control points are not present, reject this choice 
-                    #of strip immediately
-                    #this causes problems
-                    #if (2 not in subgraph or 3 not in subgraph or 
-                    #        4 not in subgraph):
-                    #    continue
-
-                    #calculate the binary fit of connectivity in this choice
-                    cur_fit = np.sum(binarize(subgraph))
-
-                    if cur_fit > best_fit:
-                        best_fit = cur_fit
-                        best_locs = [cur_loc]
-                    elif cur_fit == best_fit:
-                        best_locs.append(cur_loc)
+            for r, c in zip(*np.where(fits[orient] == best_fit)):
+                best_locs.append((int(r), int(c), orient))
 
         if best_fit < M*N*self.critical_percentage:
             return False, None, best_fit
@@ -1017,21 +1084,31 @@ def find_init_angles(all_elecs, mindist=10, maxdist=25):
     n = all_elecs.shape[0]
     angles = np.zeros(n)
     dists = np.zeros((n,2))
-    actual_points = np.zeros((n,3,3))
 
+    #find the two nearest neighbors of every electrode at once
+    neighbors = find_all_neighbors(all_elecs, 2)
+    p0 = all_elecs
+    p1 = all_elecs[neighbors[:,0]]
+    p2 = all_elecs[neighbors[:,1]]
+    actual_points = np.concatenate((p0[:,np.newaxis], p1[:,np.newaxis],
+        p2[:,np.newaxis]), axis=1).astype(float)
+
+    #the lengths and angle are computed with norm and angle on new arrays
+    #for each electrode, so that they round exactly as they do elsewhere and
+    #the comparisons with the tolerances come out the same. the dot product
+    #of rows of a larger array can round differently
     for k in xrange(n):
-        p0 = all_elecs[k,:]
-        p1, p2 = find_neighbors(p0, all_elecs, 2)
-
-        if ((mindist < norm(p1-p0) < maxdist) and (mindist 
-                < norm(p2-p0) < maxdist)):
-            angles[k] = angle(p1-p0, p2-p0)
-            dists[k] = norm(p1-p0), norm(p2-p0)
-            actual_points[k] = (p0,p1,p2)
+        v1 = p1[k] - p0[k]
+        v2 = p2[k] - p0[k]
+        d1 = norm(v1)
+        d2 = norm(v2)
+
+        if (mindist < d1 < maxdist) and (mindist < d2 < maxdist):
+            angles[k] = angle(v1, v2)
+            dists[k] = d1, d2
         else:
             angles[k] = np.inf
             dists[k] = (np.inf, np.inf)
-            actual_points[k] = (p0,p1,p2)
 
     return angles, dists, actual_points
 
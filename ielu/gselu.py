@@ -46,6 +46,17 @@ class ElectrodePositionsModel(HasPrivateTraits):
 
     use_ct_mask = Bool(False)
     disable_erosion = Bool(False)
+    low_memory_extraction = Bool(False)
+    extraction_memory_budget = Float(4.)
+    n_jobs = Int(1)
+    cache_extraction = Bool(False)
+    crop_ct = Bool(False)
+    sparse_extraction = Bool(False)
+    min_cluster_voxels = Int(0)
+    max_cluster_voxels = Int(0)
+    max_cluster_elongation = Float(0.)
+    local_extraction_radius = Int(10)
+    local_extraction_threshold = Float(0.)
     overwrite_xfms = Bool(False)
     registration_procedure = Enum('uncorrected MI registration',
         'experimental shape correction', 'no registration')
@@ -134,9 +145,15 @@ class ElectrodePositionsModel(HasPrivateTraits):
     ct_registration = File
 
     ct_threshold = Float(2500.)
+    ct_connectivity = Enum(26, 18, 6)
+    ct_threshold_index_min = Float(1000.)
+
+    _ct_component_tree = Any(transient=True) # extraction.ComponentTree
+    _ct_component_tree_params = Tuple()
     dilation_iterations = Int(25)
 
     critical_percentage = Range(0., 1., 0.75)
+    geometry_search_starts = Int(1)
 
     delta = Float(0.5)
     epsilon = Float(10.)
@@ -156,6 +173,7 @@ class ElectrodePositionsModel(HasPrivateTraits):
     #this was previously marked as transient which caused a problem with
     #adding new points after load. is there a reason it needs to be transient?
     isotropization_override = List(Float, [1.0, 1.0, 2.5] )
+    analytic_isotropization = Bool(False)
 
     roi_parcellation = Str('aparc')
     roi_error_radius = Float(4.)
@@ -169,6 +187,8 @@ class ElectrodePositionsModel(HasPrivateTraits):
     deformation_constant = Float(1.)
     sa_steps_break = Int(2500)
     sa_steps_total = Int(2500)
+    sa_n_chains = Int(1)
+    sa_split_components = Bool(False)
     sa_init_temp = Float(1e-3)
     sa_exp = Float(1.)
 
@@ -407,6 +427,56 @@ class ElectrodePositionsModel(HasPrivateTraits):
 
         return aff
 
+    def _get_ct_component_tree_params(self):
+        return (self.ct_scan, os.path.getmtime(self.ct_scan),
+            self.disable_erosion, self.isotropize,
+            tuple(self.isotropization_override), self.ct_connectivity,
+            self.analytic_isotropization)
+
+    def build_ct_component_tree(self):
+        import pipeline as pipe
+
+        self._ct_component_tree = pipe.build_ct_component_tree(
+            self.ct_scan, min_threshold=self.ct_threshold_index_min,
+            use_erosion=(not self.disable_erosion),
+            isotropization_type=self.isotropize,
+            iso_vector_override=self.isotropization_override,
+            connectivity=self.ct_connectivity,
+            analytic_isotropization=self.analytic_isotropization)
+        self._ct_component_tree_params = (
+            self._get_ct_component_tree_params())
+
+    def get_ct_component_tree(self):
+        '''
+        Returns the threshold index of the CT if one was built with the
+        current extraction parameters and covers the current threshold,
+        otherwise None
+        '''
+        if self._ct_component_tree is None:
+            return None
+        if (self._ct_component_tree_params !=
+                self._get_ct_component_tree_params()):
+            return None
+        if self.ct_threshold < self._ct_component_tree.min_threshold:
+            return None
+        return self._ct_component_tree
+
+    def get_electrode_cluster_filter(self):
+        '''
+        Returns the function used to reject electrode clusters by their
+        size and shape, or None if no limit is set. A limit of 0 is unset.
+        '''
+        import pipeline as pipe
+
+        limits = dict(min_voxels=self.min_cluster_voxels,
+            max_voxels=self.max_cluster_voxels,
+            max_elongation=self.max_cluster_elongation)
+        limits = dict((k, v) for k, v in limits.items() if v > 0)
+
+        if len(limits) == 0:
+            return None
+        return partial(pipe.filter_electrode_clusters, **limits)
+
     def run_pipeline(self):
         #setup
         if self.subjects_dir is None or self.subjects_dir=='':
@@ -438,8 +508,9 @@ class ElectrodePositionsModel(HasPrivateTraits):
         #pipeline
         import pipeline as pipe
         
+        #the brainmask in CT space is only used to crop the CT image
         #if self.use_ct_mask:
-        if False:
+        if self.use_ct_mask and self.crop_ct:
             ct_mask = pipe.create_brainmask_in_ctspace(self.ct_scan,
                 subjects_dir=self.subjects_dir, subject=self.subject,
                 overwrite=self.overwrite_xfms)
@@ -450,11 +521,34 @@ class ElectrodePositionsModel(HasPrivateTraits):
             self.ct_scan, subjects_dir=self.subjects_dir, 
             subject=self.subject)
 
-        self._electrodes = pipe.identify_electrodes_in_ctspace(
-            self.ct_scan, mask=ct_mask, threshold=self.ct_threshold,
-            use_erosion=(not self.disable_erosion),
-            isotropization_type=self.isotropize,
-            iso_vector_override=self.isotropization_override) 
+        #the threshold index covers the whole image, not the masked region,
+        #and does not compute the features used to filter clusters. it
+        #follows the standard extraction, so it is not used when a memory
+        #bounded or sparse extraction is selected
+        cluster_filter = self.get_electrode_cluster_filter()
+        ct_component_tree = (self.get_ct_component_tree() if ct_mask is None
+            and cluster_filter is None and not self.low_memory_extraction
+            and not self.sparse_extraction else None)
+        if ct_component_tree is not None:
+            self._electrodes = pipe.identify_electrodes_in_component_tree(
+                ct_component_tree, self.ct_threshold,
+                isotropization_type=self.isotropize)
+        else:
+            self._electrodes = pipe.identify_electrodes_in_ctspace(
+                self.ct_scan, mask=ct_mask, threshold=self.ct_threshold,
+                use_erosion=(not self.disable_erosion),
+                isotropization_type=self.isotropize,
+                iso_vector_override=self.isotropization_override,
+                connectivity=self.ct_connectivity,
+                memory_budget=(self.extraction_memory_budget if
+                    self.low_memory_extraction else None),
+                analytic_isotropization=self.analytic_isotropization,
+                n_jobs=self.n_jobs,
+                crop=self.crop_ct,
+                sparse=self.sparse_extraction,
+                component_filter=cluster_filter,
+                cache_dir=(os.path.join(self.subjects_dir, self.subject, 'mri',
+                    'ielu_cache') if self.cache_extraction else None))
 
         pipe.linearly_transform_electrodes_to_isotropic_coordinate_space(
             self._electrodes, self.ct_scan, 
@@ -502,7 +596,10 @@ class ElectrodePositionsModel(HasPrivateTraits):
                                          rho = self.rho,
                                          rho_strict = self.rho_strict,
                                          rho_loose = self.rho_loose,
-                                         crit_pct = self.critical_percentage
+                                         crit_pct = self.critical_percentage,
+                                         n_jobs = self.n_jobs,
+                                         search_starts = 
+                                            self.geometry_search_starts
                                         ))
         except ValueError as e:
             error_dialog(str(e))
@@ -835,6 +932,9 @@ class ElectrodePositionsModel(HasPrivateTraits):
             giveup_steps=self.sa_steps_break,
             init_temp=self.sa_init_temp,
             temperature_exponent=self.sa_exp,
+            n_chains=self.sa_n_chains,
+            split_components=self.sa_split_components,
+            n_jobs=self.n_jobs,
             )
 
         self._snapping_completed = True
@@ -971,30 +1071,73 @@ class ElectrodePositionsModel(HasPrivateTraits):
             return
     
         elif image_name == 'ct':
-            aff = self.acquire_affine()
-            import pipeline as pipe
-
-            pipe.translate_electrodes_to_surface_space( [elec], aff,
-                subjects_dir=self.subjects_dir, subject=self.subject)
-
-            pipe.linearly_transform_electrodes_to_isotropic_coordinate_space(
-                [elec], self.ct_scan,
-                isotropization_direction_off = 'copy_to_iso',
-                isotropization_direction_on = 'isotropize',
-                isotropization_strategy = self.isotropize,
-                iso_vector_override = self.isotropization_override)
+            self._add_unsorted_electrodes([elec])
         else:
             raise ValueError("Internal error: bad image type")
 
+        self._rebuild_vizpanel_event = True
+
+    def _add_unsorted_electrodes(self, electrodes):
+        '''
+        Add electrodes with only CT coordinates to the unsorted electrodes
+        '''
+        aff = self.acquire_affine()
+        import pipeline as pipe
+
+        pipe.translate_electrodes_to_surface_space( electrodes, aff,
+            subjects_dir=self.subjects_dir, subject=self.subject)
+
+        pipe.linearly_transform_electrodes_to_isotropic_coordinate_space(
+            electrodes, self.ct_scan,
+            isotropization_direction_off = 'copy_to_iso',
+            isotropization_direction_on = 'isotropize',
+            isotropization_strategy = self.isotropize,
+            iso_vector_override = self.isotropization_override)
+
         #self._grids['unsorted'] = elec
         #self._grids['unsorted'].append(elec)
 
-        self._iso_to_surf_map[ intize(elec.asiso()) ] = elec.asras()
-        self._surf_to_iso_map[ intize(elec.asras()) ] = elec.asiso()
+        for elec in electrodes:
+            self._iso_to_surf_map[ intize(elec.asiso()) ] = elec.asras()
+            self._surf_to_iso_map[ intize(elec.asras()) ] = elec.asiso()
 
-        self._iso_to_grid_ident_map[ intize(elec.asiso()) ] = 'unsorted'
-        self._all_electrodes[ intize(elec.asiso()) ] = elec
-        self._unsorted_electrodes[ intize( elec.asiso()) ] = elec
+            self._iso_to_grid_ident_map[ intize(elec.asiso()) ] = 'unsorted'
+            self._all_electrodes[ intize(elec.asiso()) ] = elec
+            self._unsorted_electrodes[ intize( elec.asiso()) ] = elec
+
+    @on_trait_change('panel2d:extract_near_cursor_event')
+    def _extract_electrodes_near_cursor(self):
+        self._commit_grid_changes()
+
+        if len(self._all_electrodes) == 0:
+            error_dialog('No electrodes loaded')
+            return
+
+        pd = self.panel2d
+        if pd.currently_showing.name != 'ct':
+            error_dialog('Finding electrodes only allowed from CT reference')
+            return
+
+        import pipeline as pipe
+        from scipy.spatial.distance import cdist
+
+        found = pipe.identify_electrodes_near_point(pd.images['ct'][0],
+            pd.cursor, radius=self.local_extraction_radius,
+            threshold=(self.local_extraction_threshold if
+                self.local_extraction_threshold != 0 else None),
+            use_erosion=(not self.disable_erosion),
+            connectivity=self.ct_connectivity)
+
+        #leave out the electrodes that are already known
+        existing = [e.asct() for e in self._all_electrodes.values()]
+        new_elecs = [e for e in found if
+            np.min(cdist([e.asct()], existing)) > 2]
+
+        print 'adding %i new electrodes' % len(new_elecs)
+        if len(new_elecs) == 0:
+            return
+
+        self._add_unsorted_electrodes(new_elecs)
 
         self._rebuild_vizpanel_event = True
 
@@ -1160,7 +1303,14 @@ class ExtractionRegistrationSortingPanel(HasTraits):
     model = Instance(ElectrodePositionsModel)
 
     ct_threshold = DelegatesTo('model')
+    ct_connectivity = DelegatesTo('model')
+    ct_threshold_index_min = DelegatesTo('model')
+
+    build_threshold_index_button = Button('Index thresholds')
+    threshold_preview = Str('')
+    threshold_preview_centers = Str('')
     critical_percentage = DelegatesTo('model')
+    geometry_search_starts = DelegatesTo('model')
     delta = DelegatesTo('model')
     epsilon = DelegatesTo('model')
     rho = DelegatesTo('model')
@@ -1174,11 +1324,24 @@ class ExtractionRegistrationSortingPanel(HasTraits):
     #visualize_in_ctspace = DelegatesTo('model')
     sa_steps_break = DelegatesTo('model')
     sa_steps_total = DelegatesTo('model')
+    sa_n_chains = DelegatesTo('model')
+    sa_split_components = DelegatesTo('model')
     sa_init_temp = DelegatesTo('model')
     sa_exp = DelegatesTo('model')
     deformation_constant = DelegatesTo('model')
     use_ct_mask = DelegatesTo('model')
     disable_erosion = DelegatesTo('model')
+    low_memory_extraction = DelegatesTo('model')
+    extraction_memory_budget = DelegatesTo('model')
+    n_jobs = DelegatesTo('model')
+    cache_extraction = DelegatesTo('model')
+    crop_ct = DelegatesTo('model')
+    sparse_extraction = DelegatesTo('model')
+    min_cluster_voxels = DelegatesTo('model')
+    max_cluster_voxels = DelegatesTo('model')
+    max_cluster_elongation = DelegatesTo('model')
+    local_extraction_radius = DelegatesTo('model')
+    local_extraction_threshold = DelegatesTo('model')
     overwrite_xfms = DelegatesTo('model')
     registration_procedure = DelegatesTo('model')
     registration_algorithm = DelegatesTo('model')
@@ -1187,6 +1350,7 @@ class ExtractionRegistrationSortingPanel(HasTraits):
     dilation_iterations = DelegatesTo('model')
     isotropize = DelegatesTo('model')
     isotropization_override = DelegatesTo('model')
+    analytic_isotropization = DelegatesTo('model')
 
     traits_view = View(
         Group(
@@ -1195,6 +1359,19 @@ class ExtractionRegistrationSortingPanel(HasTraits):
             Label('The threshold above which electrode clusters will be\n'
                 'extracted from the CT image'),
             Item('ct_threshold'),
+            Label('Index all thresholds above a minimum to preview the\n'
+                'electrode clusters found at the current threshold'),
+            HGroup(
+                Item('ct_threshold_index_min', label='minimum'),
+                Item('build_threshold_index_button', show_label=False),
+            ),
+            Item('threshold_preview', style='readonly', show_label=False),
+            Item('threshold_preview_centers', style='readonly',
+                show_label=False, editor=TextEditor(multi_line=True),
+                height=80),
+            Label('Voxel neighborhood used to group the thresholded\n'
+                'voxels into electrode clusters'),
+            Item('ct_connectivity'),
             Label('Weight given to the deformation term in the snapping\n'
                 'algorithm, reduce if snapping error is very high.'),
             Item('deformation_constant'),
@@ -1208,6 +1385,38 @@ class ExtractionRegistrationSortingPanel(HasTraits):
             Item('overwrite_xfms'),
             Label('Disable binary erosion procedure to reduce CT noise'),
             Item('disable_erosion'),
+            Label('Bound the memory used to extract electrodes, as a\n'
+                'multiple of the size of the CT image. Centers are scaled\n'
+                'instead of resampling the CT'),
+            HGroup(
+                Item('low_memory_extraction', show_label=False),
+                Item('extraction_memory_budget', show_label=True,
+                    label='budget', enabled_when='low_memory_extraction'),
+            ),
+            Label('Number of processes to use'),
+            Item('n_jobs'),
+            Label('Reuse electrodes extracted from the same CT image with\n'
+                'the same extraction parameters'),
+            Item('cache_extraction'),
+            Label('Search only the region of the CT image above threshold,\n'
+                'and inside the brainmask if masking extracranial noise'),
+            Item('crop_ct'),
+            Label('Process only the voxels above threshold, fastest when\n'
+                'the image has a large field of view'),
+            Item('sparse_extraction'),
+            Label('Reject electrode clusters by size in voxels and by the\n'
+                'ratio of their two longest axes (0 for no limit)'),
+            HGroup(
+                Item('min_cluster_voxels', label='min'),
+                Item('max_cluster_voxels', label='max'),
+                Item('max_cluster_elongation', label='elongation'),
+            ),
+            Label('Window radius and threshold used to find electrodes\n'
+                'near the cursor in the 2D panel (0 for automatic threshold)'),
+            HGroup(
+                Item('local_extraction_radius', label='radius'),
+                Item('local_extraction_threshold', label='threshold'),
+            ),
             HGroup(
                 VGroup(
                 Label('Type of registration'),
@@ -1230,10 +1439,16 @@ class ExtractionRegistrationSortingPanel(HasTraits):
                     enabled_when='isotropize==\'Manual override\'',
                     show_label=False),
             ),
+            Item('analytic_isotropization', label='Scale centers instead of '
+                'resampling CT', show_label=True,
+                enabled_when='isotropize!=\'Isotropization off\''),
         show_labels=False),
         VGroup(
             Label('The percentage of electrodes to find in sorting'),
             Item('critical_percentage'),
+            Label('The number of orderings of the geometry and starting\n'
+                'positions to try in sorting, keeping the best'),
+            Item('geometry_search_starts'),
             Label('Delta controls the distance between electrodes. That is,\n'
                 'electrode distances must be between c*(1-d) and c*(1+d),\n'
                 'where c is an estimate of the correct distance.'),
@@ -1254,6 +1469,11 @@ class ExtractionRegistrationSortingPanel(HasTraits):
                 Item('sa_steps_break', label='steps before convergence'),
                 Item('sa_steps_total', label='steps total'),
             ),
+            HGroup(
+                Item('sa_n_chains', label='independent chains'),
+                Item('sa_split_components', label='snap unconnected '
+                    'grids separately'),
+            ),
             HGroup(
                 Item('sa_init_temp', label='initial temperature'),
                 Item('sa_exp', label='exponential term'),
@@ -1266,6 +1486,29 @@ class ExtractionRegistrationSortingPanel(HasTraits):
     buttons=OKCancelButtons,
     )
 
+    def _build_threshold_index_button_fired(self):
+        if self.model.ct_scan == '':
+            error_dialog('Specify the CT image to index')
+            return
+        self.model.build_ct_component_tree()
+        self._update_threshold_preview()
+
+    @on_trait_change('ct_threshold')
+    def _update_threshold_preview(self):
+        if self.model.ct_scan == '':
+            return
+        tree = self.model.get_ct_component_tree()
+        if tree is None:
+            self.threshold_preview = ''
+            self.threshold_preview_centers = ''
+            return
+
+        centers = tree.centers(self.ct_threshold)
+        self.threshold_preview = '%i electrode clusters at threshold %s' % (
+            len(centers), self.ct_threshold)
+        self.threshold_preview_centers = '\n'.join(
+            '%i, %i, %i' % center for center in centers)
+
 class VisualizationsOutputsPanel(HasTraits):
     model = Instance(ElectrodePositionsModel)
 
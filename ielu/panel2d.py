@@ -177,6 +177,7 @@ class InfoPanel(HasTraits):
     currently_showing = Instance(NullInstanceHolder)
 
     add_electrode_button = Button('Make new elec here')
+    extract_near_cursor_button = Button('Find elecs near here')
     confirm_movepin_internal_button = Button('Move elec here')
     confirm_movepin_postproc_button = Button('Move postproc')
     track_cursor_button = Button('Track cursor')
@@ -200,6 +201,7 @@ class InfoPanel(HasTraits):
             Spring(),
             HGroup(
             Item('add_electrode_button', show_label=False),
+            Item('extract_near_cursor_button', show_label=False),
             Item('track_cursor_button', show_label=False),
             Item('reset_image_button', show_label=False),
             ),
@@ -267,6 +269,8 @@ class TwoDimensionalPanel(Handler):
     move_electrode_internally_event = Event
     move_electrode_postprocessing_event = Event
     add_electrode_event = Event
+    extract_near_cursor_button = DelegatesTo('info_panel')
+    extract_near_cursor_event = Event
     track_cursor_button = DelegatesTo('info_panel')
     track_cursor_event = Event
     untrack_cursor_event = Event
@@ -610,6 +614,9 @@ class TwoDimensionalPanel(Handler):
     def _add_electrode_button_fired(self):
         self.add_electrode_event = True
 
+    def _extract_near_cursor_button_fired(self):
+        self.extract_near_cursor_event = True
+
     def _track_cursor_button_fired(self):
         self.track_cursor_event = True
 
@@ -8,6 +8,7 @@ import numpy as np
 import nibabel as nib
 import geometry as geo
 import grid as gl
+import extraction as ext
 from utils import SortingLabelingError
 from electrode import Electrode
 from scipy.spatial.distance import cdist
@@ -85,7 +86,10 @@ def create_brainmask_in_ctspace(ct, subjects_dir=None, subject=None,
     return ct_brain
 
 def identify_electrodes_in_ctspace(ct, mask=None, threshold=2500, 
-    use_erosion=True, isotropization_type=None, iso_vector_override=None):
+    use_erosion=True, isotropization_type=None, iso_vector_override=None,
+    connectivity=26, memory_budget=None, analytic_isotropization=False,
+    n_jobs=1, cache_dir=None, crop=False, crop_margin=10,
+    component_filter=None, return_features=False, sparse=False):
     '''
     Given a CT image, identify the electrode locations in CT space.
     Includes locations of high image intensity that are not electrodes.
@@ -101,7 +105,8 @@ def identify_electrodes_in_ctspace(ct, mask=None, threshold=2500,
         The filename of an image in CT space to use as a brainmask.
         Alternately, a matrix in the same shape as the CT image.
         The use of a mask is optional and not crucial for the algorithm to
-        work well at the present time.
+        work well at the present time. The mask is only used to limit the
+        region of the image searched when crop is true.
     threshold : float | int
         The threshold used to identify the electrodes from the image.
         The intensity of the electrodes should be above this threshold, while
@@ -125,95 +130,139 @@ def identify_electrodes_in_ctspace(ct, mask=None, threshold=2500,
         Manual override : Provide a manual zoom vector
     iso_vector_override : List(Float)
         User specifies in manual override isotropization setting.
+    connectivity : 6 | 18 | 26
+        The neighborhood used to group suprathreshold voxels into electrode
+        clusters. 6 connects only voxels sharing a face, 18 also connects
+        voxels sharing an edge, and 26 also connects voxels sharing a corner.
+        The default value is 26.
+    memory_budget : None | Float
+        If None, the image is converted to floating point and processed as
+        a whole. Otherwise, the image is kept in its stored dtype and only
+        boolean masks and a compact label image are allocated next to it,
+        and the extraction fails with a MemoryError rather than holding
+        more than memory_budget times the size of the CT volume, as
+        estimated by extraction.MemoryBudget. The estimated peak is
+        reported. A resampled copy of the image would not fit in a small
+        budget, so this mode always uses analytic_isotropization.
+        The default value is None.
+    analytic_isotropization : bool
+        If true, the electrodes are extracted in the voxel grid of the CT
+        image and their centers are scaled into the isotropic coordinate
+        space by the zoom factors of the isotropization, instead of
+        resampling the image before extraction. The default value is false.
+    n_jobs : int
+        The number of processes to use. If more than 1, the image is split
+        into slabs along the z axis that are eroded and labeled in parallel.
+        The electrodes found are the same. Not used with memory_budget.
+        The default value is 1.
+    cache_dir : None | str
+        If given, the electrodes found are saved in this directory under a
+        hash of the contents of the CT image and of the parameters that
+        affect extraction, and later calls with the same image and
+        parameters load them instead of repeating the extraction.
+        The default value is None.
+    crop : bool
+        If true, the image is cropped to the bounding box of the voxels
+        above threshold before extraction, which finds the same electrodes.
+        If a mask is given, the box is further limited to the bounding box
+        of the mask, padded by crop_margin voxels, and electrodes outside of
+        it are not found. The default value is false.
+    crop_margin : int
+        The number of voxels by which the bounding box of the mask is padded.
+        The default value is 10.
+    component_filter : None | function
+        A function that takes the feature table of the electrode clusters,
+        as returned by extraction.voxel_features, and returns a boolean
+        array of the clusters to keep, such as filter_electrode_clusters.
+        If None, all clusters are kept. The default value is None.
+    return_features : bool
+        If true, the feature table of the electrodes is returned as well.
+        The default value is false.
+    sparse : bool
+        If true, only the voxels above threshold are kept after
+        thresholding, and erosion and labeling are done on this sparse set
+        of voxels, which is much faster when few voxels are above threshold.
+        The electrodes found are the same. Not used with memory_budget.
+        The default value is false.
 
     Returns
     -------
     electrodes : List(Electrode)
         an list of Electrode objects with only the ct coords indicated.
+    features : np.ndarray
+        The feature table of the electrodes, only if return_features is true
     '''
     print 'identifying electrode locations from CT image'
 
     from scipy import ndimage
-    import sys
+
+    if memory_budget is not None and isotropization_type in ('By voxel',
+            'By header', 'Manual override'):
+        print 'memory bounded extraction scales centers instead of resampling'
+        analytic_isotropization = True
 
     def get_centerofmass(isotropize=None):
         cti = nib.load(ct)   
-        ctd = cti.get_data()
-
-        if isotropization_type == 'By voxel':
-            initial_shape = ctd.shape
-
-            max_axis = np.max(ctd.shape)
-
-            #WARNING: this is not the true isotropization
-            #factor. To get the true isotropization factor we would have to
-            #trust the image to tell us its correct slice thickness.
-            #But this is usually a good approximation of the shitty slice
-            #thickness scans we have been getting.
-
-            zf = np.array([max_axis, max_axis, max_axis]) // ctd.shape
-            print 'DOING THE ISOTROPIC LINEARIZATION'
-            ctd = ndimage.interpolation.zoom(ctd, zf)
-            print 'FINISHED ISOTROPIC LINEARIZATION'
-
-            new_shape = ctd.shape
-
-            print 'INITIAL SHAPE: {0}, NEW SHAPE {1}'.format(initial_shape,
-                new_shape)
-
-        elif isotropization_type == 'By header':
-            initial_shape = ctd.shape
 
-            #these are the same thing
-            vox2ras = cti.get_affine()
-            #vox2ras = geo.get_vox2rasxfm(ct, stem='vox2ras')
+        if memory_budget is None:
+            ctd = cti.get_data()
+            budget = None
+        else:
+            #keep the image in its stored dtype. the header scaling is only
+            #applied to the voxels that end up in electrode clusters
+            ctd, scaling = ext.load_native_volume(cti)
+            budget = ext.MemoryBudget(ctd.nbytes, factor=memory_budget)
 
-            #check orientation
-            rd, ad, sd = geo.get_std_orientation(vox2ras)
+        ctd, zoom = isotropize_ct_volume(cti, ctd, isotropization_type,
+            iso_vector_override=iso_vector_override,
+            analytic_isotropization=analytic_isotropization)
 
-            vox2ras_rstd = np.array(
-                map( lambda ix: np.squeeze( vox2ras[ix, :3] ),
-                     (rd, ad, sd) ))
+        #istropization done
 
-            vox2ras_dg = np.abs(np.diag(vox2ras_rstd)[:3])
+        if budget is None:
+            print np.mean(ctd), 'CT MEAN'
+            print np.std(ctd), 'CT STDEV'
 
-            min_axis = np.min( vox2ras_dg )
-            zf = vox2ras_dg / min_axis
+            #threshold = np.mean(mask_test)+3*np.std(mask_test)
+            print threshold, 'COMPROMISE'
 
-            if np.all(zf == 1):
-                print 'IMAGE HEADER IS ISOTROPIC, NO LINEARIZATION TO DO'
+        origin = None
+        if crop:
+            if budget is None:
+                box = ext.threshold_bounding_box(ctd, threshold)
             else:
+                box = ext.threshold_bounding_box(ctd,
+                    ext.native_threshold(ctd.dtype, scaling, threshold))
 
-                print 'DOING THE ISOTROPIC LINEARIZATION'
-                ctd = ndimage.interpolation.zoom(ctd, zf)
-                print 'FINISHED ISOTROPIC LINEARIZATION'
-                new_shape = ctd.shape
-
-                print 'INITIAL SHAPE: {0}, NEW SHAPE {1}'.format(
-                    initial_shape, new_shape)
+            if mask is not None:
+                maskd = nib.load(mask).get_data() if isinstance(mask,
+                    basestring) else mask
+                box = ext.intersect_boxes(box, ext.mask_bounding_box(maskd,
+                    ctd.shape, margin=crop_margin))
 
-        elif isotropization_type == 'Manual override':
-            initial_shape = ctd.shape
-            zf = np.array(iso_vector_override)
+            if box is None:
+                print 'found 0 connected components'
+                return ext.voxel_features([], [], [], 0)
 
-            if np.all(zf == 1):
-                print 'IMAGE HEADER IS ISOTROPIC, NO LINEARIZATION TO DO'
-            else:
-                print 'DOING THE ISOTROPIC LINEARIZATION'
-                ctd = ndimage.interpolation.zoom(ctd, zf)
-                print 'FINISHED ISOTROPIC LINEARIZATION'
-                new_shape = ctd.shape
+            origin = [lo for lo, hi in box]
+            ctd = ctd[tuple(slice(lo, hi) for lo, hi in box)]
 
-                print 'INITIAL SHAPE: {0}, NEW SHAPE {1}'.format(
-                    initial_shape, new_shape)
+            print 'CROPPED TO SHAPE {0} AT {1}'.format(ctd.shape, origin)
 
-        #istropization done
+        if budget is not None:
+            return ext.extract_features_bounded(ctd, threshold,
+                use_erosion=use_erosion, connectivity=connectivity,
+                scaling=scaling, budget=budget, zoom=zoom, origin=origin)
 
-        print np.mean(ctd), 'CT MEAN'
-        print np.std(ctd), 'CT STDEV'
+        if sparse:
+            return ext.extract_features_sparse(ctd, threshold,
+                use_erosion=use_erosion, connectivity=connectivity,
+                zoom=zoom, origin=origin)
 
-        #threshold = np.mean(mask_test)+3*np.std(mask_test)
-        print threshold, 'COMPROMISE'
+        if n_jobs > 1:
+            return ext.extract_features_parallel(ctd, threshold,
+                use_erosion=use_erosion, connectivity=connectivity,
+                n_jobs=n_jobs, zoom=zoom, origin=origin)
 
         #supthresh_locs = np.where(np.logical_and(ctd > threshold, maskd))
         supthresh_locs = np.where( ctd > threshold )
@@ -229,150 +278,433 @@ def identify_electrodes_in_ctspace(ct, mask=None, threshold=2500,
         ctpp = np.zeros(ctd.shape)
         ctpp[np.where(cte)] = ctd[np.where(cte)]
 
-        class Component():
-            def __init__(self):
-                self.coor = []
-                self.intensity = []
-            def add(self, coor, intensity):
-                self.coor.append(coor)
-                self.intensity.append(intensity)
-            def center_of_mass(self):
-                M, Rx, Ry, Rz = 0,0,0,0
-                for r,m in zip(self.coor, self.intensity):
-                    M+=m
-                    Rx+=m*r[0]
-                    Ry+=m*r[1]
-                    Rz+=m*r[2]
-                return round(Rx/M), round(Ry/M), round(Rz/M)
-
-        #in principle it is possible to alter the algorithm by removing
-        #some of the subsequent categories of diagonals. in practice
+        #group the remaining voxels into electrode clusters. in principle it
+        #is possible to alter the algorithm by removing some of the
+        #categories of diagonals with the connectivity parameter. in practice
         #this makes very little difference compared to choosing an
         #appropriate threshold and having good quality images
-        def iter_bfs(x,y,z,im,c):
-            from Queue import Queue
-            queue = Queue()
+        labels, nr_components = ext.label_components(ctpp,
+            connectivity=connectivity)
 
-            queue.put( (x,y,z) )
+        print 'found %i connected components' % nr_components
 
-            while not queue.empty():
+        return ext.label_image_features(ctpp, labels, nr_components,
+            zoom=zoom, origin=origin)
 
-                cx, cy, cz = queue.get_nowait()
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = get_extraction_cache_file(ct, cache_dir,
+            threshold=threshold, use_erosion=use_erosion,
+            isotropization_type=isotropization_type,
+            iso_vector_override=(iso_vector_override if isotropization_type
+                == 'Manual override' else None),
+            connectivity=connectivity,
+            analytic_isotropization=analytic_isotropization,
+            crop_mask=((get_mask_digest(mask), crop_margin) if crop and
+                mask is not None else None))
 
-                try:
-                    if im[cx,cy,cz]==0:
-                        continue
-                except IndexError:
-                    continue
+    features = None
+    if cache_file is not None and os.path.exists(cache_file):
+        features = load_extraction_cache(cache_file)
 
-                if cx < 0 or cy < 0:
-                    continue
-                
-                c.add((cx,cy,cz), im[cx,cy,cz])
-                im[cx,cy,cz]=0
-            
-                queue.put((cx-1, cy, cz))
-                queue.put((cx+1, cy, cz))
-                queue.put((cx, cy-1, cz))
-                queue.put((cx, cy+1, cz))
-                queue.put((cx, cy, cz-1))
-                queue.put((cx, cy, cz+1))
-
-                queue.put((cx-1, cy-1, cz))
-                queue.put((cx-1, cy+1, cz))
-                queue.put((cx-1, cy, cz-1))
-                queue.put((cx-1, cy, cz+1))
-                queue.put((cx+1, cy-1, cz))
-                queue.put((cx+1, cy+1, cz))
-                queue.put((cx+1, cy, cz-1))
-                queue.put((cx+1, cy, cz+1))
-                queue.put((cx, cy-1, cz-1))
-                queue.put((cx, cy-1, cz+1))
-                queue.put((cx, cy+1, cz-1))
-                queue.put((cx, cy+1, cz+1))
-                
-                queue.put((cx-1, cy-1, cz-1))
-                queue.put((cx-1, cy-1, cz+1))
-                queue.put((cx-1, cy+1, cz-1))
-                queue.put((cx-1, cy+1, cz+1))
-                queue.put((cx+1, cy-1, cz-1))
-                queue.put((cx+1, cy-1, cz+1))
-                queue.put((cx+1, cy+1, cz-1))
-                queue.put((cx+1, cy+1, cz+1))
-
-        #this recursive function occasionally caused memory problems
-        #it also caused stack size problems
-        def dfs(x,y,z,im,c):
-            try:
-                if im[x,y,z]==0:
-                    return
-            except IndexError:
-                return
-            if x<0 or y<0:
-                return 
-
-            c.add((x,y,z), im[x,y,z])
-            im[x,y,z]=0
-            dfs(x-1,y,z,im,c)
-            dfs(x+1,y,z,im,c)
-            dfs(x,y-1,z,im,c)
-            dfs(x,y+1,z,im,c)
-            dfs(x,y,z-1,im,c)
-            dfs(x,y,z+1,im,c)
-
-            dfs(x-1, y-1, z, im, c)
-            dfs(x-1, y+1, z, im, c)
-            dfs(x-1, y, z-1, im, c)
-            dfs(x-1, y, z+1, im, c)
-            dfs(x+1, y-1, z, im, c)
-            dfs(x+1, y+1, z, im, c)
-            dfs(x+1, y, z-1, im, c)
-            dfs(x+1, y, z+1, im, c)
-            dfs(x, y-1, z-1, im, c)
-            dfs(x, y-1, z+1, im, c)
-            dfs(x, y+1, z-1, im, c)
-            dfs(x, y+1, z+1, im, c)
-
-            dfs(x-1, y-1, z-1, im, c)
-            dfs(x-1, y-1, z+1, im, c)
-            dfs(x-1, y+1, z-1, im, c)
-            dfs(x-1, y+1, z+1, im, c)
-            dfs(x+1, y-1, z-1, im, c)
-            dfs(x+1, y-1, z+1, im, c)
-            dfs(x+1, y+1, z-1, im, c)
-            dfs(x+1, y+1, z+1, im, c)
-
-        def isolate_components(image):
-            im = image.copy()
-
-            clusters=[]
-            #print np.shape(im), 'gabif'
-            for x,y,z in zip(*np.where(im)):
-                if im[x,y,z]==0:
-                    continue
-                else:
-                    c = Component()
-                    clusters.append(c)
-                    iter_bfs(x,y,z,im,c) 
-                
-            return clusters
+    if features is None:
+        features = get_centerofmass(isotropize=isotropization_type)
+        if cache_file is not None:
+            save_extraction_cache(cache_file, features)
+
+    if component_filter is not None:
+        features = features[component_filter(features)]
+        print 'kept %i electrode clusters after filtering' % len(features)
 
-        recursionlimit = sys.getrecursionlimit()
-        sys.setrecursionlimit(3000000)
+    centers = map(tuple, features['center'].tolist())
 
-        electrode_clusters = isolate_components(ctpp)
+    if isotropization_type!='Isotropization off':
+        electrodes = [Electrode(iso_coords=i) for i in centers]
+    else:
+        electrodes = [Electrode(ct_coords=c) for c in centers]
+
+    if return_features:
+        return electrodes, features
+    return electrodes
+
+def filter_electrode_clusters(features, min_voxels=None, max_voxels=None,
+    max_elongation=None):
+    '''
+    Select the electrode clusters that look like electrode contacts, to
+    reject artifacts such as skull screws, wires and dental metal before
+    sorting.
+
+    Parameters
+    ----------
+    features : np.ndarray
+        The feature table of the clusters, as returned by
+        identify_electrodes_in_ctspace with return_features
+    min_voxels : None | int
+        The smallest number of voxels in a cluster that is kept
+    max_voxels : None | int
+        The largest number of voxels in a cluster that is kept
+    max_elongation : None | float
+        The largest ratio of the longest principal axis of a cluster to its
+        second longest principal axis that is kept. Wires are elongated,
+        while contacts are about as long as they are wide. The second axis
+        is taken to be at least one voxel wide, so that clusters of two
+        voxels or of voxels on a line, such as the small remnants of
+        contacts left by erosion, are judged by their length rather than
+        rejected for their degenerate width.
+
+    Returns
+    -------
+    keep : np.ndarray
+        Boolean array of the clusters to keep
+    '''
+    keep = np.ones(len(features), dtype=bool)
+
+    if min_voxels is not None:
+        keep &= features['voxels'] >= min_voxels
+    if max_voxels is not None:
+        keep &= features['voxels'] <= max_voxels
+    if max_elongation is not None:
+        lengths = features['axis_lengths']
+        keep &= lengths[:, 0] <= max_elongation * np.maximum(lengths[:, 1],
+            1)
+
+    return keep
+
+def get_extraction_cache_file(ct, cache_dir, **params):
+    '''
+    Get the file in which the electrodes extracted from a CT image with the
+    given parameters are cached. The name of the file is a hash of the
+    contents of the CT image and of the parameters, so that a changed image
+    is never matched with stale electrodes.
+
+    Parameters
+    ----------
+    ct : str
+        The filename of the CT image
+    cache_dir : str
+        The directory containing the cache
+    params :
+        The parameters that affect extraction
+
+    Returns
+    -------
+    cache_file : str
+        The filename of the cached electrodes, which may not exist yet
+    '''
+    import hashlib
+
+    sha = hashlib.sha1()
+    with open(ct, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(2**20), ''):
+            sha.update(chunk)
+    sha.update(repr(sorted(params.items())))
+
+    return os.path.join(cache_dir, 'clusters_%s.npz' % sha.hexdigest())
+
+def get_mask_digest(mask):
+    '''
+    Returns a hash of the contents of a mask given as a filename or array
+    '''
+    import hashlib
+
+    sha = hashlib.sha1()
+    if isinstance(mask, basestring):
+        with open(mask, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(2**20), ''):
+                sha.update(chunk)
+    else:
+        sha.update(np.ascontiguousarray(mask).view(np.uint8))
+        sha.update(repr(mask.shape))
+    return sha.hexdigest()
+
+def load_extraction_cache(cache_file):
+    '''
+    Load the electrode locations extracted from a CT image from the cache.
+    Returns None if the cache file cannot be read, so that the electrodes
+    are extracted again.
+    '''
+    from zipfile import BadZipfile
+
+    try:
+        cache = np.load(cache_file)
+        try:
+            features = cache['features']
+        finally:
+            cache.close()
+    except (IOError, ValueError, KeyError, BadZipfile) as e:
+        print 'Could not read cached electrode locations: %s' % str(e)
+        return None
+
+    print 'using cached electrode locations in %s' % cache_file
+    return features
+
+def save_extraction_cache(cache_file, features):
+    '''
+    Save the electrode locations extracted from a CT image to the cache.
+    Failure to write the cache is reported but is not an error.
+
+    The cache is written to a temporary file in the same directory which is
+    then renamed, so that an interrupted write does not leave a truncated
+    cache file behind.
+    '''
+    import tempfile
+
+    cache_dir = os.path.dirname(cache_file)
+    tmp_file = None
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_file = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+        with os.fdopen(fd, 'wb') as fobj:
+            np.savez(fobj, features=features)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError) as e:
+        print 'Could not cache electrode locations: %s' % str(e)
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+
+def identify_electrodes_near_point(ctd, point, radius=10, threshold=None,
+    use_erosion=True, connectivity=26):
+    '''
+    Identify the electrode locations in a small window of the CT image
+    around a point, such as the cursor position in the 2D panel. Only the
+    few thousand voxels of the window are thresholded and labeled.
+
+    Parameters
+    ----------
+    ctd : XxYxZ np.ndarray
+        The data of the CT image
+    point : 3-tuple
+        The voxel around which to search, in CT coordinates
+    radius : int
+        The window extends radius voxels from point along each axis.
+        The default value is 10.
+    threshold : None | float | int
+        The threshold used to identify the electrodes. If None, the
+        threshold is chosen from the intensities in the window.
+        The default value is None.
+    use_erosion : bool
+        If true, binary erosion is applied. The default value is true.
+    connectivity : 6 | 18 | 26
+        As in identify_electrodes_in_ctspace. The default value is 26.
+
+    Returns
+    -------
+    electrodes : List(Electrode)
+        an list of Electrode objects with only the ct coords indicated.
+    '''
+    features, threshold = ext.extract_features_near_point(ctd, point,
+        radius=radius, threshold=threshold, use_erosion=use_erosion,
+        connectivity=connectivity)
+
+    print 'found %i electrode clusters near %s with threshold %.1f' % (
+        len(features), str(tuple(point)), threshold)
+
+    return [Electrode(ct_coords=c) for c in
+        map(tuple, features['center'].tolist())]
+
+def build_ct_component_tree(ct, min_threshold=1000, use_erosion=True,
+    isotropization_type=None, iso_vector_override=None, connectivity=26,
+    analytic_isotropization=False):
+    '''
+    Index the electrode clusters of a CT image at every threshold above
+    min_threshold, so that the electrodes found at any of these thresholds
+    can be read without repeating the extraction.
+
+    Parameters
+    ----------
+    ct : str
+        The filename of the CT image to use
+    min_threshold : float | int
+        The lowest threshold that can be queried. Lower values index more
+        of the image and take longer to build. The default value is 1000.
+    use_erosion, isotropization_type, iso_vector_override, connectivity,
+    analytic_isotropization :
+        As in identify_electrodes_in_ctspace
+
+    Returns
+    -------
+    tree : extraction.ComponentTree
+        The index, to be read with identify_electrodes_in_component_tree
+    '''
+    print 'building electrode threshold index from CT image'
+
+    cti = nib.load(ct)
+    ctd = cti.get_data()
 
-        sys.setrecursionlimit(recursionlimit)
+    ctd, zoom = isotropize_ct_volume(cti, ctd, isotropization_type,
+        iso_vector_override=iso_vector_override,
+        analytic_isotropization=analytic_isotropization)
 
-        return [cluster.center_of_mass() for cluster in electrode_clusters]
+    return ext.ComponentTree(ctd, min_threshold, use_erosion=use_erosion,
+        connectivity=connectivity, zoom=zoom)
 
-    ret_elecs = []
+def identify_electrodes_in_component_tree(tree, threshold,
+    isotropization_type=None):
+    '''
+    Identify the electrode locations found at threshold from an index built
+    with build_ct_component_tree. The electrodes are the same as those
+    returned by identify_electrodes_in_ctspace with the same parameters.
+
+    Parameters
+    ----------
+    tree : extraction.ComponentTree
+        The index of the CT image
+    threshold : float | int
+        The threshold used to identify the electrodes
+    isotropization_type : str | None
+        The isotropization type the index was built with
+
+    Returns
+    -------
+    electrodes : List(Electrode)
+        an list of Electrode objects with only the ct coords indicated.
+    '''
     if isotropization_type!='Isotropization off':
-        return [Electrode(iso_coords=i) for i in 
-            get_centerofmass(isotropize=isotropization_type)]
+        return [Electrode(iso_coords=i) for i in tree.centers(threshold)]
+    else:
+        return [Electrode(ct_coords=c) for c in tree.centers(threshold)]
+
+def isotropize_ct_volume(cti, ctd, isotropization_type,
+    iso_vector_override=None, analytic_isotropization=False):
+    '''
+    Resample the CT volume into the isotropic coordinate space used for
+    electrode extraction
+
+    Parameters
+    ----------
+    cti : nibabel image
+        The CT image
+    ctd : XxYxZ np.ndarray
+        The data of the CT image
+    isotropization_type : str
+        As in identify_electrodes_in_ctspace
+    iso_vector_override : List(Float)
+        provided for manual isotropization_type
+    analytic_isotropization : bool
+        If true, the volume is left in its voxel grid and the zoom factors
+        to apply to the extracted centers are returned instead
+
+    Returns
+    -------
+    ctd : XxYxZ np.ndarray
+        The resampled volume
+    zoom : None | np.ndarray
+        The zoom factors still to be applied to the extracted centers
+    '''
+    from scipy import ndimage
+
+    def zoom_volume(ctd, zf):
+        print 'DOING THE ISOTROPIC LINEARIZATION'
+        ctd = ndimage.interpolation.zoom(ctd, zf)
+        print 'FINISHED ISOTROPIC LINEARIZATION'
+        return ctd
+
+    zoom = None
+    if analytic_isotropization and isotropization_type in ('By voxel',
+            'By header', 'Manual override'):
+        #the centers are scaled by the same factors used to move
+        #electrodes between ct and iso coordinates
+        zoom = get_isotropic_zoom_factors(cti, isotropization_type,
+            iso_vector_override=iso_vector_override)
+
+        print 'EXTRACTING IN NATIVE GRID, ZOOM FACTORS {0}'.format(zoom)
+
+    elif isotropization_type == 'By voxel':
+        initial_shape = ctd.shape
+
+        max_axis = np.max(ctd.shape)
+
+        #WARNING: this is not the true isotropization
+        #factor. To get the true isotropization factor we would have to
+        #trust the image to tell us its correct slice thickness.
+        #But this is usually a good approximation of the shitty slice
+        #thickness scans we have been getting.
+
+        zf = np.array([max_axis, max_axis, max_axis]) // ctd.shape
+        ctd = zoom_volume(ctd, zf)
+
+        new_shape = ctd.shape
+
+        print 'INITIAL SHAPE: {0}, NEW SHAPE {1}'.format(initial_shape,
+            new_shape)
+
+    elif isotropization_type == 'By header':
+        initial_shape = ctd.shape
+
+        #these are the same thing
+        vox2ras = cti.get_affine()
+        #vox2ras = geo.get_vox2rasxfm(ct, stem='vox2ras')
+
+        #check orientation
+        rd, ad, sd = geo.get_std_orientation(vox2ras)
+
+        vox2ras_rstd = np.array(
+            map( lambda ix: np.squeeze( vox2ras[ix, :3] ),
+                 (rd, ad, sd) ))
+
+        vox2ras_dg = np.abs(np.diag(vox2ras_rstd)[:3])
+
+        min_axis = np.min( vox2ras_dg )
+        zf = vox2ras_dg / min_axis
+
+        if np.all(zf == 1):
+            print 'IMAGE HEADER IS ISOTROPIC, NO LINEARIZATION TO DO'
+        else:
+
+            ctd = zoom_volume(ctd, zf)
+            new_shape = ctd.shape
+
+            print 'INITIAL SHAPE: {0}, NEW SHAPE {1}'.format(
+                initial_shape, new_shape)
+
+    elif isotropization_type == 'Manual override':
+        initial_shape = ctd.shape
+        zf = np.array(iso_vector_override)
+
+        if np.all(zf == 1):
+            print 'IMAGE HEADER IS ISOTROPIC, NO LINEARIZATION TO DO'
+        else:
+            ctd = zoom_volume(ctd, zf)
+            new_shape = ctd.shape
+
+            print 'INITIAL SHAPE: {0}, NEW SHAPE {1}'.format(
+                initial_shape, new_shape)
+
+    return ctd, zoom
+
+def get_isotropic_zoom_factors(cti, isotropization_strategy,
+    iso_vector_override=None):
+    '''
+    Get the factors by which each axis of the CT image is stretched to
+    move from CT coordinates to isotropic coordinates
+
+    Parameters
+    ----------
+    cti : nibabel image
+        The CT image
+    isotropization_strategy : 'By voxel' | 'By header' | 'Manual override'
+    iso_vector_override: List(Float)
+        provided for manual isotropization_strategy
+
+    Returns
+    -------
+    zf : np.ndarray
+        The zoom factor of each axis
+    '''
+    if isotropization_strategy == 'By voxel':
+        cts_max = np.max(cti.shape)
+        return np.array([cts_max, cts_max, cts_max]) / cti.shape
+    elif isotropization_strategy == 'By header':
+        aff = cti.get_affine()
+        aff_rstd = np.array( map( lambda ix: aff[ix, :3],
+                                  geo.get_std_orientation(aff)))
+        aff_dg = np.abs(np.diag(aff_rstd)[:3])
+        return aff_dg / np.min(aff_dg)
+    elif isotropization_strategy == 'Manual override':
+        return np.array(iso_vector_override)
     else:
-        return [Electrode(ct_coords=c) for c in
-            get_centerofmass(isotropize=isotropization_type)]
+        raise ValueError('Invalid isotropization strategy')
 
 def linearly_transform_electrodes_to_isotropic_coordinate_space(electrodes,
     ct, isotropization_direction_on=None,
@@ -413,19 +745,8 @@ def linearly_transform_electrodes_to_isotropic_coordinate_space(electrodes,
 
             continue
 
-        elif isotropization_strategy == 'By voxel':
-            cts_max = np.max(cti.shape)
-            za, zb, zc = np.array([cts_max, cts_max, cts_max]) / cti.shape
-        elif isotropization_strategy == 'By header':
-            aff = cti.get_affine()
-            aff_rstd = np.array( map( lambda ix: aff[ix, :3],
-                                      geo.get_std_orientation(aff)))
-            aff_dg = np.abs(np.diag(aff_rstd)[:3])
-            za, zb, zc = aff_dg / np.min(aff_dg)
-        elif isotropization_strategy == 'Manual override':
-            za, zb, zc = np.array(iso_vector_override)
-        else:
-            raise ValueError('Invalid isotropization strategy')
+        za, zb, zc = get_isotropic_zoom_factors(cti, isotropization_strategy,
+            iso_vector_override=iso_vector_override)
 
         if isotropization_direction_on == 'isotropize':
             ca, cb, cc = elec.asct()
@@ -499,7 +820,8 @@ def identify_extracranial_electrodes_in_freesurfer_space(electrodes,
 
 def classify_electrodes(electrodes, known_geometry,
     delta=.35, rho=35, rho_strict=20, rho_loose=50, color_scheme=None,
-    epsilon=10, mindist=0, maxdist=36, crit_pct=.75):
+    epsilon=10, mindist=0, maxdist=36, crit_pct=.75, n_jobs=1,
+    search_starts=1):
     '''
     Sort the given electrodes (generally in the space of the CT scan) into
     grids and strips matching the specified geometry.
@@ -557,6 +879,20 @@ def classify_electrodes(electrodes, known_geometry,
     crit_pct : Float
         The critical percentage of electrodes to find before returning.
         Default value 0.75
+    n_jobs : int
+        The number of processes used to grow grids from the candidate
+        starting positions. If more than 1, batches of n_jobs starting
+        positions are tried at once. The first starting position in order
+        that fits is chosen either way, so the result does not depend on
+        n_jobs. The default value is 1.
+    search_starts : int
+        The number of different orderings of the geometry and choices of
+        starting position to try. If more than 1, each candidate sorts all of
+        the geometry, the candidates are run in n_jobs processes, and the
+        assignment that places the most electrodes with the fewest
+        interpolated points is returned. The grids are then named in the
+        order the chosen candidate fit them. The first candidate is the
+        single pass done by default. The default value is 1.
 
     Returns
     -------
@@ -588,15 +924,110 @@ def classify_electrodes(electrodes, known_geometry,
     grid_colors['unsorted'] = (1,0,0)
     grid_colors['selection'] = (1,1,1)
     grid_geom = {}
-    used_points = []
 
-    for dims in known_geometry:
-        new_elecs = geo.rm_pts(np.reshape(used_points, (-1,3)), 
-            np.array(electrode_arr))
+    grid_params = dict(delta=delta, rho=rho, rho_strict=rho_strict,
+        rho_loose=rho_loose, critical_percentage=crit_pct)
+    angle_params = dict(epsilon=epsilon, mindist=mindist, maxdist=maxdist)
+
+    if search_starts > 1:
+        known_geometry, strips = search_geometry_assignments(electrode_arr,
+            known_geometry, grid_params, angle_params, search_starts, n_jobs)
+    else:
+        strips = assign_geometry(electrode_arr, known_geometry, grid_params,
+            angle_params, n_jobs=n_jobs)
+
+    for dims, (nr_attempts, strip) in zip(known_geometry, strips):
+        #each initialization tried uses up a name
+        for _ in xrange(nr_attempts):
+            name = names.next()
+
+        found_grids[name] = []
+        grid_colors[name] = colors.next()
+        grid_geom[name] = dims
+
+        if strip is None:
+            continue
+
+        members, corners, final_connectivity = strip
+
+        for ix, p in members:
+            if ix is not None:
+                elec = electrodes[ix]
+                found_grids[name].append(elec)
+            else:
+                #elec = Electrode(ct_coords=tuple(p), 
+                #    is_interpolation=True)
+                elec = Electrode(iso_coords=tuple(p),
+                    is_interpolation=True)
+                found_grids[name].append(elec)
+
+            #add corner information
+            for corner in corners:
+                if np.all(corner==np.array(elec.asiso())):
+                    elec.corner = ['corner 1']
+
+            #add experimental full geometry information
+
+            try:
+                elec.geom_coords = list(final_connectivity[
+                    elec.asiso()])
+            except KeyError:
+                pass
+
+    #return found_grids, grid_colors
+    return grid_colors, grid_geom, found_grids, colors
+
+def assign_geometry(electrode_arr, known_geometry, grid_params,
+    angle_params, n_jobs=1, skip_seeds=0):
+    '''
+    Fit strips of each of the known geometries in turn onto the electrode
+    locations, removing the electrodes of each strip before fitting the
+    next. This is the sorting pass of classify_electrodes, on coordinates
+    only.
+
+    Parameters
+    ----------
+    electrode_arr : List(3-tuple)
+        The electrode locations
+    known_geometry : list of 2-tuples
+        The geometries to fit, in order
+    grid_params : Dict
+        The fitting parameters passed to each Grid
+    angle_params : Dict
+        The epsilon, mindist and maxdist parameters of classify_electrodes
+    n_jobs : int
+        The number of processes used to grow grids from starting positions
+    skip_seeds : int
+        The number of best starting positions of the first geometry to
+        pass over. The default value is 0.
+
+    Returns
+    -------
+    strips : List(2-tuple)
+        For each geometry, the number of starting positions tried and either
+        None if no strip fit, or a tuple (members, corners,
+        final_connectivity) where members lists the strip points as tuples
+        (index, point) and index is the position of the electrode in
+        electrode_arr, or None for an interpolated point
+    '''
+    epsilon = angle_params['epsilon']
+
+    #map each location to the electrodes found there, and keep track of the
+    #electrodes still available to later geometries
+    electrode_index = {}
+    for i, coords in enumerate(electrode_arr):
+        electrode_index.setdefault(tuple(coords), []).append(i)
+    available = np.ones(len(electrode_arr), dtype=bool)
+    electrode_coords = np.array(electrode_arr)
+
+    strips = []
+
+    for g, dims in enumerate(known_geometry):
+        new_elecs = electrode_coords[available]
 
         #TODO mindist and maxdist settable parameters
-        angles, _, neighbs = gl.find_init_angles(new_elecs, mindist=mindist, 
-            maxdist=maxdist)
+        angles, _, neighbs = gl.find_init_angles(new_elecs, 
+            mindist=angle_params['mindist'], maxdist=angle_params['maxdist'])
 
         #from PyQt4.QtCore import pyqtRemoveInputHook
         #pyqtRemoveInputHook()
@@ -608,76 +1039,195 @@ def classify_electrodes(electrodes, known_geometry,
 
         if ba.shape==():
             ba=[ba]
-        elif len(ba)==0:
+        if g==0:
+            ba=ba[skip_seeds:]
+        if len(ba)==0:
             raise SortingLabelingError("Could not find any good angles")
 
-        for j,k in enumerate(ba):
-            p0,p1,p2 = neighbs[k]
-            pog = gl.Grid(p0,p1,p2,new_elecs, delta=delta,
-                rho=rho, rho_strict=rho_strict, rho_loose=rho_loose,
-                name=names.next(), critical_percentage=crit_pct)
-            pog.extend_grid_arbitrarily()
+        seeds = [(neighbs[k], new_elecs, dims, grid_params) for k in ba]
+        result = None
 
-            try:
-                sp, corners, final_connectivity = pog.extract_strip(*dims)
-            except SortingLabelingError as e:
+        for j, strip in enumerate(grow_grids_from_seeds(seeds, n_jobs)):
+            if strip is None:
                 print 'Rejected this initialization'
                 if j==len(ba)-1:
                     print ('No suitable strip found. Returning an empty '
                         'strip in its place')
-                    found_grids[pog.name] = []
-                    grid_colors[pog.name] = colors.next()
-                    grid_geom[pog.name] = dims
                 continue
 
+            sp, corners, final_connectivity = strip
+
             sp = np.reshape(sp, (-1,3))
 
-            found_grids[pog.name] = []
-            grid_colors[pog.name] = colors.next()
-            grid_geom[pog.name] = dims
+            members = []
             for p in sp:
-                used_points.append(p)
-                #from PyQt4.QtCore import pyqtRemoveInputHook
-                #pyqtRemoveInputHook()
-                #import pdb
-                #pdb.set_trace()
-                if tuple(p.tolist()) in electrode_arr:
-                    ix, = np.where(np.logical_and(np.logical_and( 
-                        np.array(electrode_arr)[:,0]==p[0], 
-                        np.array(electrode_arr)[:,1]==p[1]),
-                        np.array(electrode_arr)[:,2]==p[2]))
-                    try:
-                        elec = electrodes[ix]
-                        found_grids[pog.name].append(elec)
-                    except (IndexError, TypeError) as e:
+                ix = electrode_index.get(tuple(p.tolist()), [])
+                if len(ix) > 0:
+                    available[ix[0]] = False
+                    if len(ix) > 1:
                         print ix
                         print p
                         raise SortingLabelingError(
                             "multiple electrodes at same point")
+                    members.append((ix[0], p))
                 else:
-                    #elec = Electrode(ct_coords=tuple(p), 
-                    #    is_interpolation=True)
-                    elec = Electrode(iso_coords=tuple(p),
-                        is_interpolation=True)
-                    found_grids[pog.name].append(elec)
+                    members.append((None, p))
+
+            result = (members, corners, final_connectivity)
+            break
 
-                #add corner information
-                for corner in corners:
-                    if np.all(corner==np.array(elec.asiso())):
-                        elec.corner = ['corner 1']
+        strips.append((j+1, result))
 
-                #add experimental full geometry information
+    return strips
 
-                try:
-                    elec.geom_coords = list(final_connectivity[
-                        elec.asiso()])
-                except KeyError:
-                    pass
-                    
+def _assign_geometry_candidate(args):
+    #errors are returned rather than raised, a candidate that fails to sort
+    #is just passed over
+    electrode_arr, known_geometry, grid_params, angle_params, skip_seeds = args
+    try:
+        return assign_geometry(electrode_arr, known_geometry, grid_params,
+            angle_params, skip_seeds=skip_seeds)
+    except Exception as e:
+        return e
+
+def geometry_search_candidates(known_geometry, nr_candidates):
+    '''
+    Returns nr_candidates tuples (ordering, skip_seeds) to try in a search
+    over geometry assignments. The orderings are the given order, then the
+    largest geometries first, then the remaining distinct permutations. All
+    of the orderings are tried with the best starting position before any is
+    tried with the next best.
+    '''
+    from itertools import chain, imap, permutations
+
+    known_geometry = map(tuple, known_geometry)
+
+    #the permutations are generated lazily, there are many for a large
+    #geometry
+    orderings = []
+    for ordering in chain([known_geometry, 
+            sorted(known_geometry, key=lambda d:-d[0]*d[1])],
+            imap(list, permutations(known_geometry))):
+        if len(orderings) == nr_candidates:
             break
+        if ordering not in orderings:
+            orderings.append(ordering)
 
-    #return found_grids, grid_colors
-    return grid_colors, grid_geom, found_grids, colors
+    candidates = []
+    skip_seeds = 0
+    while len(candidates) < nr_candidates:
+        for ordering in orderings[:nr_candidates-len(candidates)]:
+            candidates.append((ordering, skip_seeds))
+        skip_seeds += 1
+
+    return candidates
+
+def score_geometry_assignment(strips):
+    '''
+    Score the output of assign_geometry. Assignments that place more actual
+    electrodes score higher, and between those, ones with fewer interpolated
+    points.
+    '''
+    nr_found = 0
+    nr_interpolated = 0
+    for _, strip in strips:
+        if strip is None:
+            continue
+        for ix, _ in strip[0]:
+            if ix is None:
+                nr_interpolated += 1
+            else:
+                nr_found += 1
+    return nr_found, -nr_interpolated
+
+def search_geometry_assignments(electrode_arr, known_geometry, grid_params,
+    angle_params, nr_candidates, n_jobs=1):
+    '''
+    Run assign_geometry over the candidates of geometry_search_candidates in
+    a pool of n_jobs processes, and return the ordering of the geometry and
+    the strips of the best scoring assignment. Ties go to the earlier
+    candidate. If every candidate fails, the error of the first is raised.
+    '''
+    candidates = geometry_search_candidates(known_geometry, nr_candidates)
+    jobs = [(electrode_arr, ordering, grid_params, angle_params, skip_seeds)
+        for ordering, skip_seeds in candidates]
+
+    if n_jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(n_jobs, len(jobs)))
+        try:
+            results = pool.map(_assign_geometry_candidate, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_assign_geometry_candidate, jobs)
+
+    best = None
+    for (ordering, skip_seeds), strips in zip(candidates, results):
+        if isinstance(strips, Exception):
+            continue
+        score = score_geometry_assignment(strips)
+        print 'Geometry %s skipping %i seeds scored %s' % (ordering,
+            skip_seeds, score)
+        if best is None or score > best[0]:
+            best = (score, ordering, strips)
+
+    if best is None:
+        raise results[0]
+
+    return best[1], best[2]
+
+def grow_grid_from_seed(args):
+    '''
+    Grow a grid from one starting position and extract a strip of the given
+    geometry from it.
+
+    Returns the points, corners and connectivity of the strip as returned by
+    Grid.extract_strip, or None if no strip fits.
+    '''
+    (p0, p1, p2), elecs, dims, grid_params = args
+
+    pog = gl.Grid(p0, p1, p2, elecs, **grid_params)
+    pog.extend_grid_arbitrarily()
+
+    try:
+        return pog.extract_strip(*dims)
+    except SortingLabelingError as e:
+        return None
+
+def _grow_grid_from_seed_in_pool(args):
+    #errors are returned rather than raised so that an error from a seed
+    #after the chosen one does not abort the batch
+    try:
+        return grow_grid_from_seed(args)
+    except Exception as e:
+        return e
+
+def grow_grids_from_seeds(seeds, n_jobs=1):
+    '''
+    Lazily generate the result of grow_grid_from_seed for each seed in
+    order. If n_jobs is more than 1, batches of n_jobs seeds are grown in a
+    pool of processes, so that at most one batch is spent past the first
+    seed the caller accepts.
+    '''
+    if n_jobs <= 1 or len(seeds) <= 1:
+        for seed in seeds:
+            yield grow_grid_from_seed(seed)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(min(n_jobs, len(seeds)))
+    try:
+        for start in xrange(0, len(seeds), n_jobs):
+            for result in pool.map(_grow_grid_from_seed_in_pool,
+                    seeds[start:start+n_jobs]):
+                if isinstance(result, Exception):
+                    raise result
+                yield result
+    finally:
+        pool.close()
+        pool.join()
 
 
 def remove_large_negative_values_from_ct(ct, subjects_dir=None,
@@ -1175,7 +1725,8 @@ def translate_electrodes_to_surface_space(electrodes, ct2mr,
 def snap_electrodes_to_surface(electrodes, subjects_dir=None, 
     subject=None, max_steps=40000, giveup_steps=10000, 
     init_temp=1e-3, temperature_exponent=1,
-    deformation_constant=1.):
+    deformation_constant=1., seed=None, n_chains=1, n_jobs=1,
+    split_components=False):
     '''
     Transforms electrodes from surface space to positions on the surface
     using a simulated annealing "snapping" algorithm which minimizes an
@@ -1212,6 +1763,23 @@ def snap_electrodes_to_surface(electrodes, subjects_dir=None,
         the deformation and displacement are weighted equally. When less than
         1, there is assumed to be considerable deformation and the spring
         condition is weighted more highly than the deformation condition.
+    seed : None | Int
+        The seed of the random moves. If None, the global numpy random state
+        is used. The default value is None.
+    n_chains : Int
+        The number of independent annealing chains to run. The electrodes
+        are placed where the chain with the lowest energy found them. If more
+        than 1 chain or component is annealed, each is given its own seed,
+        drawn from seed. The
+        default value is 1.
+    n_jobs : Int
+        The number of processes over which to divide the chains and
+        components. The default value is 1.
+    split_components : Bool
+        If True, the groups of electrodes that are not connected by virtual
+        springs, usually separate grids and strips, are annealed separately
+        with the steps divided between them by size. The default value is
+        False.
 
     There is no return value. The 'snap_coords' attribute will be used to
     store the snapped locations of the electrodes
@@ -1222,6 +1790,8 @@ def snap_electrodes_to_surface(electrodes, subjects_dir=None,
         subject = os.environ['SUBJECT']
 
     from scipy.spatial.distance import cdist
+    from scipy.spatial import cKDTree
+    from scipy import sparse
 
     n = len(electrodes)
     electrode_arr = map((lambda x:getattr(x, 'surf_coords')), electrodes)
@@ -1230,76 +1800,40 @@ def snap_electrodes_to_surface(electrodes, subjects_dir=None,
     # first set the alpha parameter exactly as described in Dykstra 2012.
     # this parameter controls which electrodes have virtual springs connected.
     # this may not matter but doing it is fast and safe
-    alpha = np.zeros((n,n))
-    init_dist = cdist(e_init, e_init)
+    elec_tree = cKDTree(e_init)
 
-    neighbors = []
+    #take 5 highest neighbors, which are those closer than the sixth
+    #nearest point counting the electrode itself
+    _, nearest = elec_tree.query(e_init, k=6)
+    nearest_dists = np.sqrt(np.sum(
+        (e_init[nearest] - e_init[:, np.newaxis])**2, axis=-1))
+    nearest_dists.sort(axis=1)
 
-    for i in xrange(n):
-        neighbor_vec = init_dist[:,i]
-        #take 5 highest neighbors
-        h5, = np.where(np.logical_and(neighbor_vec<np.sort(neighbor_vec)[5],
-            neighbor_vec != 0))
-
-        neighbors.append( h5 )
-
-    neighbors = np.squeeze(neighbors)
-
-    # get distances from each neighbor pairing
-    neighbor_dists = []
-    for i in xrange(n):
-        neighbor_dists.append( init_dist[i, neighbors[i]] )
-
-    neighbor_dists = np.hstack(neighbor_dists)
+    neighbor_dists = nearest_dists[np.logical_and(
+        nearest_dists < nearest_dists[:, -1:], nearest_dists != 0)]
 
     #collect distance into histogram of resolution 0.2
-    max = np.max( np.around(neighbor_dists) )
-    min = np.min( np.around(neighbor_dists) )
+    hi = np.max( np.around(neighbor_dists) )
+    lo = np.min( np.around(neighbor_dists) )
 
-    hist,_ = np.histogram(neighbor_dists, bins=(max-min)/2, range=(min, max))
+    hist,_ = np.histogram(neighbor_dists, bins=int((hi-lo)/2), range=(lo, hi))
 
-    fundist = np.argmax(hist)*2 + min + 1
+    fundist = np.argmax(hist)*2 + lo + 1
 
-    #apply fundist to alpha matrix
+    #apply fundist to alpha matrix, connecting every pair of electrodes
+    #closer than the spring radius. alpha is symmetric and sparse
     alpha_tweak = 1.75
+    radius = fundist*alpha_tweak
 
-    for i in xrange(n):
-        neighbor_vec = init_dist[:,i]
-        neighbor_vec[i] = np.inf
-
-        neighbors = np.where( neighbor_vec < fundist*alpha_tweak )
-
-        if len(neighbors) > 5:
-            neighbors = np.where( neighbor_vec < np.sort(neighbor_vec)[5] )
-
-        if len(neighbors) == 0:
-            closest = np.argmin( neighbors )
-            neighbors = np.where( neighbor_vec < closest*alpha_tweak )
-
-        alpha[i,neighbors]=1
-
-        for j in xrange(i):
-            if alpha[j,i]==1:
-                alpha[i,j]=1 
-            if alpha[i,j]==1:
-                alpha[j,i]=1
+    pairs = np.array(list(elec_tree.query_pairs(radius*(1+1e-9))),
+        dtype=int).reshape(-1, 2)
+    pair_dists = np.sqrt(np.sum(
+        (e_init[pairs[:, 0]] - e_init[pairs[:, 1]])**2, axis=-1))
+    pairs = pairs[pair_dists < radius]
 
-    # alpha is set, now do the annealing
-    def energycost(e_new, e_old, alpha):
-        n = len(alpha)
-
-        dist_new = cdist(e_new, e_new)
-        dist_old = cdist(e_old, e_old)
-
-        H=0
-
-        for i in xrange(n):
-            H += deformation_constant*float(cdist( [e_new[i]], [e_old[i]] ))
-
-            for j in xrange(i):
-                H += alpha[i,j] * (dist_new[i,j] - dist_old[i,j])**2
-
-        return H
+    alpha = sparse.coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+        shape=(n,n))
+    alpha = (alpha + alpha.T).tocsr()
 
     #load the dural surface locations
     lh_dura, _ = nib.freesurfer.read_geometry(
@@ -1325,6 +1859,212 @@ def snap_electrodes_to_surface(electrodes, subjects_dir=None,
 
     dura = np.vstack((lh_dura, rh_dura))
 
+    #index the surface once so that moves only look at nearby vertices
+    dura_tree = cKDTree(dura)
+
+    #start e-init as greedy snap to surface
+    e_snapgreedy = dura[np.argmin(cdist(dura, e_init), axis=0)]
+
+    schedule = (max_steps, giveup_steps, init_temp, temperature_exponent)
+
+    if split_components:
+        #electrodes that are not connected by springs do not affect each
+        #other, so each connected component is annealed on its own. the
+        #steps are divided between the components as they would be on
+        #average if the components were annealed together
+        from scipy.sparse.csgraph import connected_components
+        nr_components, labels = connected_components(alpha, directed=False)
+
+        problems = []
+        for c in xrange(nr_components):
+            component, = np.where(labels == c)
+            scale = float(len(component)) / n
+            problems.append((component, (
+                int(np.ceil(max_steps*scale)),
+                int(np.ceil(giveup_steps*scale)),
+                init_temp, temperature_exponent)))
+    else:
+        problems = [(np.arange(n), schedule)]
+
+    jobs = []
+    for component, component_schedule in problems:
+        energy = snapping_energy_terms(e_init[component],
+            alpha[component][:, component], deformation_constant)
+        for _ in xrange(n_chains):
+            jobs.append([e_snapgreedy[component], energy, dura, dura_tree,
+                component_schedule, seed])
+
+    if len(jobs) > 1:
+        #give every job its own seed so that the result does not depend
+        #on how the jobs are divided over the processes
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        job_seeds = rng.randint(np.iinfo(np.int32).max, size=len(jobs))
+        for job, job_seed in zip(jobs, job_seeds):
+            job[-1] = job_seed
+
+    jobs = map(tuple, jobs)
+
+    if n_jobs > 1 and len(jobs) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(n_jobs, len(jobs)))
+        try:
+            results = pool.map(anneal_electrodes_to_surface, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(anneal_electrodes_to_surface, jobs)
+
+    #keep the lowest energy of the chains of each component, ties go to
+    #the earlier chain
+    emin = np.array(e_snapgreedy).copy()
+    for c, (component, _) in enumerate(problems):
+        best = None
+        for i in xrange(n_chains):
+            job = c*n_chains + i
+            chain_emin, mincost = results[job]
+            if len(jobs) > 1:
+                print ('component %i chain %i with seed %i ... lowest cost = '
+                    '%f' % (c, i, jobs[job][-1], mincost))
+            if best is None or mincost < best[1]:
+                best = (chain_emin, mincost)
+
+        emin[component] = best[0]
+
+    #return the emin coordinates
+    for elec, loc in zip(electrodes, emin):
+        elec.snap_coords = loc
+
+    #return the nearest vertex on the pial surface 
+    lh_pia, _ = nib.freesurfer.read_geometry(
+        os.path.join(subjects_dir, subject, 'surf', 'lh.pial'))
+    
+    rh_pia, _ = nib.freesurfer.read_geometry(
+        os.path.join(subjects_dir, subject, 'surf', 'rh.pial'))
+
+    #expand the pial surfaces slightly to better visualize the electrodes
+    #lh_pia =geo.expand_triangular_mesh(lh_pia, com_bias=(-2, 0, 0), offset=18)
+    #rh_pia = geo.expand_triangular_mesh(rh_pia, com_bias=(2, 0, 0), offset=18)
+
+
+    #adjust x-axis offsets as pysurfer illogically does as hard-coded step
+    #lh_pia[:, 0] -= np.max(lh_pia[:, 0])
+    #rh_pia[:, 0] -= np.min(rh_pia[:, 0])
+
+
+    pia = np.vstack((lh_pia, rh_pia))
+
+    e_pia = np.argmin(cdist(pia, emin), axis=0)
+
+    for elec, soln in zip(electrodes, e_pia):
+        elec.vertno = soln if soln<len(lh_pia) else soln-len(lh_pia)
+        elec.hemi = 'lh' if soln<len(lh_pia) else 'rh'
+        elec.pial_coords = pia[soln]
+
+
+def snapping_energy_terms(e_init, alpha, deformation_constant=1.):
+    '''
+    Lay out the terms of the snapping energy of a set of electrodes, for use
+    by anneal_electrodes_to_surface.
+
+    Parameters
+    ----------
+    e_init : Nx3 np.ndarray
+        The initial locations of the electrodes
+    alpha : NxN scipy.sparse matrix
+        The symmetric spring weights between the electrodes
+    deformation_constant : Float
+        The weight of the displacement terms. The default value is 1.
+
+    Returns
+    -------
+    energy : Tuple
+        The initial locations, the position of the displacement term of each
+        electrode, a list of (position, other electrode, weight, rest length)
+        for the springs of each electrode, the number of terms and the
+        deformation constant
+    '''
+    from scipy.spatial.distance import cdist
+    from scipy import sparse
+
+    n = len(e_init)
+
+    # the energy is a displacement term for each electrode, added in order
+    # of the electrodes and each followed by the spring terms of the pairs
+    # it forms with the electrodes before it. moving one electrode only
+    # changes its own terms, so the terms are kept in an array and only
+    # those of the moved electrode are recomputed. the terms of pairs not
+    # connected in alpha are zero and are left out. the array is summed
+    # sequentially so that the energy does not depend on which electrodes
+    # were moved before
+    lower_alpha = sparse.tril(alpha, k=-1, format='csr')
+    lower_alpha.sort_indices()
+
+    disp_terms = np.zeros(n, dtype=int)
+    springs = [[] for _ in xrange(n)]
+    nr_terms = 0
+    for i in xrange(n):
+        disp_terms[i] = nr_terms
+        nr_terms += 1
+
+        row = slice(lower_alpha.indptr[i], lower_alpha.indptr[i+1])
+        others = lower_alpha.indices[row]
+        if len(others) == 0:
+            continue
+        rest_lengths = cdist([e_init[i]], e_init[others])[0]
+
+        for j, weight, rest in zip(others, lower_alpha.data[row],
+                rest_lengths):
+            springs[i].append((nr_terms, j, weight, rest))
+            springs[j].append((nr_terms, i, weight, rest))
+            nr_terms += 1
+
+    return (e_init, disp_terms, springs, nr_terms, deformation_constant)
+
+
+def anneal_electrodes_to_surface(args):
+    '''
+    Run one simulated annealing chain of snap_electrodes_to_surface, moving
+    the electrodes between vertices of the dural surface.
+
+    The arguments are passed as a single tuple so that chains can be run in
+    a pool of processes. They are the starting locations of the electrodes,
+    the energy (the initial locations, the positions of the displacement
+    terms, the springs of each electrode, the number of terms and the
+    deformation constant), the dural surface and a KD-tree over it, the
+    annealing schedule (max_steps, giveup_steps, init_temp and
+    temperature_exponent) and the seed of the random moves. If the seed is
+    None, the global numpy random state is used.
+
+    Returns
+    -------
+    emin : Nx3 np.ndarray
+        The locations of the electrodes with the lowest energy found
+    mincost : Float
+        The lowest energy found
+    '''
+    from scipy.spatial.distance import cdist
+
+    (e_start, (e_init, disp_terms, springs, nr_terms, deformation_constant),
+        dura, dura_tree, (max_steps, giveup_steps, init_temp,
+        temperature_exponent), seed) = args
+
+    n = len(e_init)
+
+    def electrode_terms(e_cur, k, loc):
+        #the positions and new values of the terms of electrode k at loc
+        positions = [disp_terms[k]]
+        values = [deformation_constant*float(cdist( [loc], [e_init[k]] ))]
+
+        if len(springs[k]) > 0:
+            others = [j for _, j, _, _ in springs[k]]
+            dists = cdist([loc], e_cur[others])[0]
+            for (pos, _, weight, rest), d in zip(springs[k], dists):
+                positions.append(pos)
+                values.append(weight * (d - rest)**2)
+
+        return positions, values
+
     max_deformation = 3
     deformation_choice = 50
 
@@ -1341,11 +2081,15 @@ def snap_electrodes_to_surface(electrodes, subjects_dir=None,
     h=0; hcnt=0
     lowcost = mincost = 1e6
 
-    #start e-init as greedy snap to surface
-    e_snapgreedy = dura[np.argmin(cdist(dura, e_init), axis=0)]
+    e = np.array(e_start).copy()
+    emin = np.array(e_start).copy()
 
-    e = np.array(e_snapgreedy).copy()
-    emin = np.array(e_snapgreedy).copy()
+    terms = np.zeros(nr_terms)
+    for k in xrange(n):
+        positions, values = electrode_terms(e, k, e[k])
+        terms[positions] = values
+
+    rng = np.random if seed is None else np.random.RandomState(seed)
 
     #the annealing schedule continues until the maximum number of moves
     while h<H:
@@ -1358,26 +2102,26 @@ def snap_electrodes_to_surface(electrodes, subjects_dir=None,
         T=T0*(Texp**h)
 
         #select a random electrode
-        e1 = np.random.randint(n)
+        e1 = rng.randint(n)
         #transpose it with a *nearby* point on the surface
 
-        #find distances from this point to all points on the surface
-        dists = np.squeeze(cdist(dura, [e[e1]]))
-        #take a distance within the minimum 5X
-
-        #mindist = np.min(dists) 
-        mindist = np.sort(dists)[deformation_choice]
-        candidate_verts, = np.where( dists < mindist*max_deformation )
-        choice_vert = candidate_verts[np.random.randint(len(candidate_verts))]
+        #find the points on the surface within a distance of some multiple
+        #of the distance to the nearest points
+        candidate_verts = nearby_surface_vertices(dura, dura_tree, e[e1],
+            deformation_choice, max_deformation)
+        choice_vert = candidate_verts[rng.randint(len(candidate_verts))]
         
         e_tmp = e.copy()
         #print choice_vert
         #print np.shape(candidate_verts)
         e_tmp[e1] = dura[choice_vert]
 
-        cost = energycost(e_tmp, e_init, alpha)
+        positions, values = electrode_terms(e_tmp, e1, e_tmp[e1])
+        old_values = terms[positions]
+        terms[positions] = values
+        cost = np.cumsum(terms)[-1]
 
-        if cost < lowcost or np.random.random()<np.exp(-(cost-lowcost)/T):
+        if cost < lowcost or rng.random_sample()<np.exp(-(cost-lowcost)/T):
             e = e_tmp 
             lowcost = cost
 
@@ -1390,38 +2134,57 @@ def snap_electrodes_to_surface(electrodes, subjects_dir=None,
             if mincost==0:
                 break
 
-        print 'step %i ... final lowest cost = %f' % (h, mincost)
-
-    #return the emin coordinates
-    for elec, loc in zip(electrodes, emin):
-        elec.snap_coords = loc
+        else:
+            terms[positions] = old_values
 
-    #return the nearest vertex on the pial surface 
-    lh_pia, _ = nib.freesurfer.read_geometry(
-        os.path.join(subjects_dir, subject, 'surf', 'lh.pial'))
-    
-    rh_pia, _ = nib.freesurfer.read_geometry(
-        os.path.join(subjects_dir, subject, 'surf', 'rh.pial'))
+        print 'step %i ... final lowest cost = %f' % (h, mincost)
 
-    #expand the pial surfaces slightly to better visualize the electrodes
-    #lh_pia =geo.expand_triangular_mesh(lh_pia, com_bias=(-2, 0, 0), offset=18)
-    #rh_pia = geo.expand_triangular_mesh(rh_pia, com_bias=(2, 0, 0), offset=18)
+    return emin, mincost
 
 
-    #adjust x-axis offsets as pysurfer illogically does as hard-coded step
-    #lh_pia[:, 0] -= np.max(lh_pia[:, 0])
-    #rh_pia[:, 0] -= np.min(rh_pia[:, 0])
+def nearby_surface_vertices(surface, tree, loc, nr_nearest=50,
+    max_deformation=3):
+    '''
+    Find the vertices of a surface that are closer to loc than
+    max_deformation times the distance to its nr_nearest+1'th nearest vertex.
+    The vertices are found with a KD-tree over the surface and checked with
+    exact distances, so they are the same as comparing the distances from
+    loc to every vertex.
 
+    Parameters
+    ----------
+    surface : Vx3 np.ndarray
+        The surface vertices
+    tree : scipy.spatial.cKDTree
+        A KD-tree built over surface
+    loc : 3-tuple
+        The location
+    nr_nearest : Int
+        The position of the reference distance among the sorted distances.
+        The default value is 50.
+    max_deformation : Float
+        The multiple of the reference distance. The default value is 3.
 
-    pia = np.vstack((lh_pia, rh_pia))
+    Returns
+    -------
+    verts : np.ndarray
+        The indices of the vertices, in increasing order
+    '''
+    from scipy.spatial.distance import cdist
 
-    e_pia = np.argmin(cdist(pia, emin), axis=0)
+    #every vertex within the reference distance is within the distance of
+    #the nr_nearest+1 vertices found by the tree. a little slack covers the
+    #rounding of the tree distances
+    slack = 1 + 1e-9
+    _, nearest = tree.query(loc, k=nr_nearest+1)
+    radius = np.max(cdist(surface[nearest], [loc]))
 
-    for elec, soln in zip(electrodes, e_pia):
-        elec.vertno = soln if soln<len(lh_pia) else soln-len(lh_pia)
-        elec.hemi = 'lh' if soln<len(lh_pia) else 'rh'
-        elec.pial_coords = pia[soln]
+    verts = np.sort(np.array(tree.query_ball_point(loc, 
+        radius*max(max_deformation, 1)*slack), dtype=int))
+    dists = cdist(surface[verts], [loc])[:,0]
 
+    mindist = np.sort(dists)[nr_nearest]
+    return verts[dists < mindist*max_deformation]
 
 def fit_grid_to_line(electrodes, mindist=0, maxdist=36, epsilon=30, delta=.5,
     rho=35, rho_strict=20, rho_loose=50):
@@ -1457,14 +2220,17 @@ def fit_grid_to_line(electrodes, mindist=0, maxdist=36, epsilon=30, delta=.5,
     if len(pog.points) < len(electrodes):
         raise SortingLabelingError('Failed to fit all the electrodes')
 
+    conns = [pog.get_2d_point(elec.iso_coords) for elec in electrodes]
+    if None in conns:
+        raise SortingLabelingError('Failed to fit all the electrodes')
+
     miny=0
-    for elec in electrodes:
-        y = pog.connectivity[gl.GridPoint(elec.iso_coords)][1]
+    for conn in conns:
+        y = conn[1]
         if y<miny:
             miny=y
 
-    for elec in electrodes:
-        conn = pog.connectivity[gl.GridPoint(elec.iso_coords)]
+    for elec, conn in zip(electrodes, conns):
         elec.geom_coords = [0, conn[1]-miny]
 
 def fit_grid_by_fixed_points(electrodes, geom, 
@@ -1574,7 +2340,8 @@ def fit_grid_by_fixed_points(electrodes, geom,
         break
 
 
-def fit_grid_to_plane(electrodes, c1, c2, c3, geom, reverse_grid='check'):
+def fit_grid_to_plane(electrodes, c1, c2, c3, geom, reverse_grid='check',
+    solver='greedy'):
     '''
     Given a list of electrodes and three corners of a plane, fit the
     electrodes onto the plane using a snapping algorithm minimizing a global
@@ -1595,12 +2362,22 @@ def fit_grid_to_plane(electrodes, c1, c2, c3, geom, reverse_grid='check'):
         minimum. If False, Y is the maximum. If 'check', checks the grids
         current geometry information for this, which could conceivably fail
         if there are not enough points filled in.
+    solver : 'greedy' | 'optimal'
+        How the electrodes without existing geometry information are
+        assigned to the remaining points of the plane. If 'greedy', each
+        electrode in turn takes the nearest remaining point. If 'optimal',
+        the assignment minimizing the total squared distance of all of them
+        is found at once. Electrodes with existing geometry information keep
+        it in both cases. The default value is 'greedy'.
 
     No return value
     '''
     #a,b,c,d = geo.find_plane_from_corners(c1, c2, c3)
     from scipy.spatial.distance import cdist, pdist
 
+    if solver not in ('greedy', 'optimal'):
+        raise ValueError('Invalid solver %s' % solver)
+
     c1 = np.array(c1)
     c2 = np.array(c2)
     c3 = np.array(c3)
@@ -1679,14 +2456,33 @@ def fit_grid_to_plane(electrodes, c1, c2, c3, geom, reverse_grid='check'):
         e_init_ix = np.argmin(cdist([e_init_choice], plane_points))
         plane_points = np.delete(plane_points, e_init_ix, axis=0)
 
-    #assign remaining electrodes greedily
-    for elec in electrodes:
-        if len(elec.geom_coords) != 0:
-            continue
+    if solver == 'optimal':
+        #assign remaining electrodes by solving the assignment problem over
+        #the whole cost matrix
+        from scipy.optimize import linear_sum_assignment
+
+        free_elecs = [elec for elec in electrodes if 
+            len(elec.geom_coords) == 0]
+
+        if len(free_elecs) > len(plane_points):
+            raise SortingLabelingError('More electrodes than points in the '
+                'geometry')
+
+        if len(free_elecs) > 0:
+            cost = cdist([elec.asiso() for elec in free_elecs], plane_points,
+                'sqeuclidean')
+            for e, p in zip(*linear_sum_assignment(cost)):
+                pp[free_elecs[e].asiso()] = plane_points[p]
+
+    else:
+        #assign remaining electrodes greedily
+        for elec in electrodes:
+            if len(elec.geom_coords) != 0:
+                continue
 
-        e_greedy_choice = np.argmin(cdist([elec.asiso()], plane_points))
-        pp[elec.asiso()] = plane_points[e_greedy_choice]
-        plane_points = np.delete(plane_points, e_greedy_choice, axis=0)
+            e_greedy_choice = np.argmin(cdist([elec.asiso()], plane_points))
+            pp[elec.asiso()] = plane_points[e_greedy_choice]
+            plane_points = np.delete(plane_points, e_greedy_choice, axis=0)
 
 #    pp_min = pp.copy()
 #